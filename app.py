@@ -1,17 +1,29 @@
 import streamlit as st
-from src.model import source_data
-from src.ui import explorer
+from src.model import source_data, datasources, pushdown
+from src.ui import explorer, admin
 
 
 def run():
     """Main streamlit app entry point"""
     # Fetch source data - do this before auth to ensure all requests to app cause data refresh
-    # Read, parse, and cache (via @st.cache_data) source data
+    # Read, parse, and cache (via @st.cache_resource) source data shared by all sessions
     with st.spinner("Initializing..."):
-        src_data = source_data.from_s3()
+        if datasources.BACKEND == "pushdown":
+            src_data = pushdown.from_s3()
+        elif datasources.SNAPSHOT_DIR:
+            src_data = source_data.from_snapshot()
+        elif datasources.REFRESH_SECONDS:
+            src_data = source_data.from_refresher()
+        elif datasources.R2_MANIFEST:
+            src_data = source_data.from_partitions()
+        else:
+            src_data = source_data.from_s3()
 
-    # Show the main page
-    explorer.st_page(src_data)
+    # Show the main page, or admin page with ?view=admin
+    if st.query_params.get("view") == "admin":
+        admin.st_page(src_data)
+    else:
+        explorer.st_page(src_data)
 
 
 def clear_cache():
@@ -19,6 +31,17 @@ def clear_cache():
     Clear Streamlit cache so source_data module will reread DB from disk on next request
     """
     st.cache_data.clear()
+    for load_fn in [
+        source_data.from_file,
+        source_data.from_s3,
+        source_data.from_snapshot,
+        source_data.from_partitions,
+        pushdown.from_file,
+        pushdown.from_s3,
+    ]:
+        load_fn.clear()
+    if datasources.REFRESH_SECONDS:
+        source_data.refresher().refresh()
     return st.markdown(
         'Cache cleared. <a href="/" target="_self">Return to dashboard.</a>',
         unsafe_allow_html=True,
@@ -0,0 +1,156 @@
+"""
+Panel attribution: choose the service provider each patient is paneled to from their
+encounters. Strategies are written as sort/group operations over the whole encounters
+table rather than per-patient loops, and as a partial -> combine reduction so they can
+also run over a stream of encounter chunks.
+"""
+
+import pandas as pd
+from abc import ABC, abstractmethod
+from datetime import date
+from dataclasses import dataclass, field
+from dateutil.relativedelta import relativedelta
+from typing import Iterator
+
+# Default lookback window for the plurality strategy
+DEFAULT_MONTHS = 24
+
+
+class Strategy(ABC):
+    """
+    Base attribution strategy. partial() reduces a set of encounters to per-patient
+    state, combine() merges concatenated states from several partial() calls, and
+    finalize() returns a dataframe with columns prw_id, service_provider.
+    """
+
+    # Encounter columns needed by this strategy
+    columns = ["prw_id", "service_provider"]
+
+    @abstractmethod
+    def partial(self, encounters_df: pd.DataFrame) -> pd.DataFrame:
+        pass
+
+    def combine(self, state_df: pd.DataFrame) -> pd.DataFrame:
+        return self.partial(state_df)
+
+    def finalize(self, state_df: pd.DataFrame) -> pd.DataFrame:
+        return state_df[["prw_id", "service_provider"]].reset_index(drop=True)
+
+
+class FirstEncounter(Strategy):
+    """
+    Provider of the first encounter in source order with a non-null provider
+    """
+
+    def partial(self, encounters_df):
+        return encounters_df.groupby("prw_id")["service_provider"].first().reset_index()
+
+
+class MostRecent(Strategy):
+    """
+    Provider of the latest encounter by encounter_date with a non-null provider
+    """
+
+    columns = ["prw_id", "encounter_date", "service_provider"]
+
+    def partial(self, encounters_df):
+        df = encounters_df.loc[
+            encounters_df["service_provider"].notna(), self.columns
+        ].copy()
+        df["encounter_date"] = pd.to_datetime(df["encounter_date"])
+        # Stable sort, so ties on date keep source order and the last one wins
+        df = df.sort_values(["prw_id", "encounter_date"], kind="stable")
+        return df.drop_duplicates("prw_id", keep="last")
+
+
+@dataclass
+class Plurality(Strategy):
+    """
+    Provider seen most often in encounters over the lookback window, counting only the
+    primary (first listed) provider of each encounter. Ties go to the provider seen most
+    recently.
+    """
+
+    months: int = DEFAULT_MONTHS
+    # Window end. Fixed when the strategy is created so all chunks use the same window.
+    as_of: date = field(default_factory=date.today)
+
+    columns = ["prw_id", "encounter_date", "service_provider"]
+
+    def partial(self, encounters_df):
+        start = pd.Timestamp(self.as_of - relativedelta(months=self.months))
+        encounter_date = pd.to_datetime(encounters_df["encounter_date"])
+        df = encounters_df.loc[
+            (encounter_date >= start) & encounters_df["service_provider"].notna(),
+            ["prw_id"],
+        ]
+        df["service_provider"] = (
+            encounters_df.loc[df.index, "service_provider"].str.split("\n").str[0]
+        )
+        df["last_date"] = encounter_date[df.index]
+        df["count"] = 1
+        return self.combine(df)
+
+    def combine(self, state_df):
+        return (
+            state_df.groupby(["prw_id", "service_provider"], sort=False)
+            .agg(count=("count", "sum"), last_date=("last_date", "max"))
+            .reset_index()
+        )
+
+    def finalize(self, state_df):
+        df = state_df.sort_values(
+            ["prw_id", "count", "last_date"], ascending=[True, False, False]
+        )
+        df = df.drop_duplicates("prw_id", keep="first")
+        return super().finalize(df)
+
+
+STRATEGIES = {
+    "first": FirstEncounter,
+    "recent": MostRecent,
+    "plurality": Plurality,
+}
+
+
+def get_strategy(name: str, months: int = DEFAULT_MONTHS) -> Strategy:
+    """
+    Return a strategy instance by name from STRATEGIES
+    """
+    if name == "plurality":
+        return Plurality(months=months)
+    return STRATEGIES[name]()
+
+
+def attribute(encounters_df: pd.DataFrame, strategy: Strategy) -> pd.DataFrame:
+    """
+    Return the attributed service_provider for each prw_id in encounters_df
+    """
+    return strategy.finalize(strategy.partial(encounters_df))
+
+
+def attribute_chunked(
+    chunks: Iterator[pd.DataFrame], strategy: Strategy
+) -> pd.DataFrame:
+    """
+    Same as attribute(), accumulated over a stream of encounter chunks in source order.
+    Memory is bounded by the size of the per-patient state, not the number of encounters.
+    """
+    state_df = None
+    for chunk in chunks:
+        chunk_state = strategy.partial(chunk)
+        if state_df is not None:
+            # Earlier chunks come first so order-dependent strategies see source order
+            chunk_state = strategy.combine(
+                pd.concat([state_df, chunk_state], ignore_index=True)
+            )
+        state_df = chunk_state
+
+    if state_df is None:
+        return pd.DataFrame(
+            {
+                "prw_id": pd.Series(dtype="int64"),
+                "service_provider": pd.Series(dtype="object"),
+            }
+        )
+    return strategy.finalize(state_df)
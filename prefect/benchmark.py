@@ -0,0 +1,387 @@
+"""
+Ingest benchmark on synthetic data. Generates prw_patients and prw_encounters tables in
+a local SQLite warehouse at several scales and runs extract -> transform -> write against
+each, recording time per stage, rows/sec and peak RSS to a JSON file.
+
+eg. python benchmark.py --scales 10000 100000 1000000 --out bench_ingest.json
+
+With --attribution-only, instead times each panel attribution strategy on in-memory
+synthetic encounters at each scale.
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+import platform
+import numpy as np
+import pandas as pd
+import multiprocessing as mp
+from queue import Empty
+from datetime import datetime
+from sqlmodel import SQLModel
+from model import panel_model
+from util import util
+import attribution
+import ingest_panel
+
+# Encounter rows per scale. Patients are generated at 1 per ENCOUNTERS_PER_PATIENT.
+DEFAULT_SCALES = [10_000, 100_000, 1_000_000, 10_000_000]
+ENCOUNTERS_PER_PATIENT = 10
+
+# Rows generated and written to the synthetic warehouse at a time
+GENERATE_CHUNK = 500_000
+
+CITIES = ["pullman", "moscow", "colfax", "palouse", "albion", "uniontown", "lewiston"]
+STATES = ["wa", "id"]
+ENCOUNTER_TYPES = [
+    "Office Visit [101]",
+    "Telemedicine [1012]",
+    "Well Child [1013]",
+    "Procedure visit [1014]",
+    "Nurse Only [1015]",
+]
+LEVELS_OF_SERVICE = [
+    "99212 - LVL 2 EST",
+    "99213 - LVL 3 EST",
+    "99214 - LVL 4 EST",
+    "99203 - LVL 3 NEW",
+    None,
+]
+DIAGNOSES = ["Z00.129 Well child", "J06.9 URI", "I10 Hypertension", "E11.9 T2DM", None]
+
+
+# -------------------------------------------------------
+# Synthetic data
+# -------------------------------------------------------
+def generate_patients(rng, start: int, n: int) -> pd.DataFrame:
+    """
+    Return n synthetic prw_patients rows with prw_id starting at start
+    """
+    providers = list(ingest_panel.PROVIDER_TO_LOCATION.keys())
+    age = rng.integers(0, 100, n)
+    return pd.DataFrame(
+        {
+            "id": np.arange(start, start + n),
+            "prw_id": np.arange(start, start + n),
+            "mrn": (np.arange(start, start + n) + 100000).astype(str),
+            "sex": rng.choice(["M", "F", "O"], n, p=[0.49, 0.49, 0.02]),
+            "age": age,
+            "age_in_mo": age * 12 + rng.integers(0, 12, n),
+            "city": rng.choice(CITIES, n),
+            "state": rng.choice(STATES, n),
+            "pcp": rng.choice(providers, n),
+        }
+    )
+
+
+def generate_encounters(rng, start: int, n: int, n_patients: int) -> pd.DataFrame:
+    """
+    Return n synthetic prw_encounters rows with id starting at start, for patients with
+    prw_id in [0, n_patients)
+    """
+    providers = np.array(list(ingest_panel.PROVIDER_TO_LOCATION.keys()))
+    prw_id = rng.integers(0, n_patients, n)
+    # service_provider lists one or two providers separated by newlines
+    service_provider = pd.Series(rng.choice(providers, n))
+    second = rng.random(n) < 0.3
+    service_provider[second] = (
+        service_provider[second] + "\n" + rng.choice(providers, second.sum())
+    )
+    encounter_date = pd.Timestamp("2020-01-01") + pd.to_timedelta(
+        rng.integers(0, 5 * 365, n), unit="D"
+    )
+    return pd.DataFrame(
+        {
+            "id": np.arange(start, start + n),
+            "prw_id": prw_id,
+            "mrn": (prw_id + 100000).astype(str),
+            "location": rng.choice(list(ingest_panel.CLINIC_IDS.keys()), n),
+            "encounter_date": encounter_date,
+            "encounter_type": rng.choice(ENCOUNTER_TYPES, n),
+            "service_provider": service_provider,
+            "with_pcp": rng.random(n) < 0.6,
+            "diagnoses": rng.choice(DIAGNOSES, n),
+            "level_of_service": rng.choice(LEVELS_OF_SERVICE, n),
+            "dept": rng.choice(list(ingest_panel.CLINIC_IDS.keys()), n),
+            "encounter_time": encounter_date
+            + pd.to_timedelta(rng.integers(8 * 60, 17 * 60, n), unit="min"),
+            "billing_provider": rng.choice(providers, n),
+            "appt_status": rng.choice(["Completed", "Arrived"], n),
+        }
+    )
+
+
+def generate_warehouse(engine, n_encounters: int, seed: int = 0) -> None:
+    """
+    Populate prw_patients and prw_encounters in engine with synthetic data
+    """
+    rng = np.random.default_rng(seed)
+    n_patients = max(1, n_encounters // ENCOUNTERS_PER_PATIENT)
+    with engine.begin() as conn:
+        for start in range(0, n_patients, GENERATE_CHUNK):
+            n = min(GENERATE_CHUNK, n_patients - start)
+            generate_patients(rng, start, n).to_sql(
+                "prw_patients", conn, if_exists="append", index=False
+            )
+        for start in range(0, n_encounters, GENERATE_CHUNK):
+            n = min(GENERATE_CHUNK, n_encounters - start)
+            generate_encounters(rng, start, n, n_patients).to_sql(
+                "prw_encounters", conn, if_exists="append", index=False
+            )
+
+
+# -------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------
+def run_scale(prw_path: str, panel_path: str, opts: dict) -> dict:
+    """
+    Ingest the synthetic warehouse at prw_path into panel_path and return timings. Runs in
+    a child process so peak RSS is measured for this ingest alone.
+    """
+    if os.path.exists(panel_path):
+        os.remove(panel_path)
+    in_engine = util.get_db_connection(f"sqlite:///{prw_path}")
+    out_engine = util.get_db_connection(f"sqlite:///{panel_path}")
+    SQLModel.metadata.create_all(out_engine)
+
+    def write(out):
+        util.write_tables_to_db(
+            out_engine,
+            [
+                util.TableData(table=panel_model.Patient, df=out.patients_df),
+                util.TableData(table=panel_model.Encounter, df=out.encounters_df),
+            ],
+        )
+        util.analyze_tables(out_engine, [panel_model.Patient, panel_model.Encounter])
+
+    strategy = attribution.get_strategy(opts["attribution"])
+    stats = []
+    start = time.perf_counter()
+    if opts["chunksize"] > 0:
+        # Extract, transform and write are interleaved when streaming
+        with util.measure_stage("extract_transform_write", stats):
+            out = ingest_panel.transform_chunked(in_engine, opts["chunksize"], strategy)
+            write(out)
+    else:
+        with util.measure_stage("extract", stats):
+            src = ingest_panel.read_source_tables(in_engine, opts["parallel_extract"])
+        with util.measure_stage("transform", stats):
+            out = ingest_panel.transform(src, opts["workers"], strategy)
+            del src
+        with util.measure_stage("write", stats):
+            write(out)
+    total_seconds = time.perf_counter() - start
+    peak_rss_mb = max(stage.peak_rss_mb for stage in stats)
+
+    in_engine.dispose()
+    out_engine.dispose()
+    os.remove(panel_path)
+    return {
+        "stages": {
+            stage.stage: {
+                "seconds": stage.wall_seconds,
+                "cpu_seconds": stage.cpu_seconds,
+                "peak_rss_mb": stage.peak_rss_mb,
+            }
+            for stage in stats
+        },
+        "total_seconds": round(total_seconds, 4),
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def _run_scale_child(queue, prw_path, panel_path, opts):
+    logging.basicConfig(level=logging.WARNING)
+    queue.put(run_scale(prw_path, panel_path, opts))
+
+
+def wait_for_result(proc, queue) -> dict | None:
+    """
+    Return the result the child process put on queue and wait for it to exit, or return
+    None if it exited without a result
+    """
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not proc.is_alive():
+                # The result may have arrived between the last get() and the exit
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    pass
+                break
+    proc.join()
+    return result
+
+
+def run_benchmark(scales: list[int], workdir: str, opts: dict) -> dict:
+    """
+    Generate a warehouse at each scale, ingest it in a fresh process, and return all results
+    """
+    ctx = mp.get_context("spawn")
+    results = []
+    for n_encounters in scales:
+        logging.info(f"Benchmarking {n_encounters} encounters")
+        prw_path = os.path.join(workdir, f"prw_{n_encounters}.sqlite3")
+        panel_path = os.path.join(workdir, f"panel_{n_encounters}.sqlite3")
+        if os.path.exists(prw_path):
+            os.remove(prw_path)
+
+        in_engine = util.get_db_connection(f"sqlite:///{prw_path}")
+        start = time.perf_counter()
+        generate_warehouse(in_engine, n_encounters)
+        generate_seconds = time.perf_counter() - start
+        in_engine.dispose()
+
+        queue = ctx.Queue()
+        proc = ctx.Process(
+            target=_run_scale_child, args=(queue, prw_path, panel_path, opts)
+        )
+        proc.start()
+        result = wait_for_result(proc, queue)
+        os.remove(prw_path)
+
+        n_patients = max(1, n_encounters // ENCOUNTERS_PER_PATIENT)
+        n_rows = n_patients + n_encounters
+        if result is None:
+            # eg. killed for running out of memory, which is a result worth recording
+            if os.path.exists(panel_path):
+                os.remove(panel_path)
+            result = {"error": f"Ingest process exited with code {proc.exitcode}"}
+            logging.error(f"{n_encounters} encounters: {result['error']}")
+        else:
+            for stage in result["stages"].values():
+                stage["rows_per_sec"] = round(n_rows / max(stage["seconds"], 1e-9))
+            result["rows_per_sec"] = round(n_rows / max(result["total_seconds"], 1e-9))
+        result = {
+            "encounters": n_encounters,
+            "patients": n_patients,
+            "generate_seconds": round(generate_seconds, 4),
+            **result,
+        }
+        logging.info(json.dumps(result))
+        results.append(result)
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "options": opts,
+        "results": results,
+    }
+
+
+def run_attribution_benchmark(scales: list[int]) -> dict:
+    """
+    Time each attribution strategy on in-memory synthetic encounters at each scale
+    """
+    rng = np.random.default_rng(0)
+    results = []
+    for n_encounters in scales:
+        n_patients = max(1, n_encounters // ENCOUNTERS_PER_PATIENT)
+        encounters_df = generate_encounters(rng, 0, n_encounters, n_patients)
+        for name in attribution.STRATEGIES:
+            strategy = attribution.get_strategy(name)
+            start = time.perf_counter()
+            attribution.attribute(encounters_df, strategy)
+            seconds = time.perf_counter() - start
+            result = {
+                "encounters": n_encounters,
+                "strategy": name,
+                "seconds": round(seconds, 4),
+                "rows_per_sec": round(n_encounters / max(seconds, 1e-9)),
+            }
+            logging.info(json.dumps(result))
+            results.append(result)
+        del encounters_df
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "attribution": results,
+    }
+
+
+# -------------------------------------------------------
+# Main entry point
+# -------------------------------------------------------
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark panel ingest on synthetic data."
+    )
+    parser.add_argument(
+        "-s",
+        "--scales",
+        help="Number of encounter rows to benchmark at",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+    )
+    parser.add_argument(
+        "-o",
+        "--out",
+        help="Output JSON file",
+        default="bench_ingest.json",
+    )
+    parser.add_argument(
+        "-d",
+        "--workdir",
+        help="Directory for temporary SQLite warehouse and panel DBs",
+        default=tempfile.gettempdir(),
+    )
+    parser.add_argument(
+        "-c", "--chunksize", help="See ingest_panel.py", type=int, default=0
+    )
+    parser.add_argument(
+        "-w", "--workers", help="See ingest_panel.py", type=int, default=1
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel-extract",
+        help="See ingest_panel.py",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-a",
+        "--attribution",
+        help="See ingest_panel.py",
+        choices=attribution.STRATEGIES.keys(),
+        default="first",
+    )
+    parser.add_argument(
+        "--attribution-only",
+        help="Only benchmark attribution strategies, without a DB",
+        action="store_true",
+    )
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_arguments()
+    opts = {
+        "chunksize": args.chunksize,
+        "workers": args.workers,
+        "parallel_extract": args.parallel_extract,
+        "attribution": args.attribution,
+    }
+
+    if args.attribution_only:
+        results = run_attribution_benchmark(args.scales)
+    else:
+        results = run_benchmark(args.scales, args.workdir, opts)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Wrote results to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
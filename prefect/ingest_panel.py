@@ -1,15 +1,22 @@
 import os
+import re
+import time
 import logging
 import argparse
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 from dataclasses import dataclass
-from sqlmodel import Session
+from sqlalchemy import bindparam
+from sqlmodel import text
 from dotenv import load_dotenv
 from sqlmodel import SQLModel
 from model import panel_model
 from util import util
-
+import attribution
 
 # -------------------------------------------------------
 # Config
@@ -21,6 +28,64 @@ load_dotenv()
 PRW_DB_ODBC = os.environ.get("PRW_DB_ODBC", "sqlite:///prw.sqlite3")
 PANEL_DB_ODBC = os.environ.get("PANEL_DB_ODBC", "sqlite:///panel.sqlite3")
 
+# Number of rows per chunk when streaming source tables. 0 reads whole tables into memory.
+CHUNKSIZE = int(os.environ.get("PRW_CHUNKSIZE", "0"))
+
+# Read source tables concurrently, each over its own pooled connection
+PARALLEL_EXTRACT = os.environ.get("PRW_PARALLEL_EXTRACT", "").lower() in ("1", "true")
+
+# Number of processes used to transform the encounters table. 1 transforms in-process.
+TRANSFORM_WORKERS = int(os.environ.get("PRW_TRANSFORM_WORKERS", "1"))
+
+# Panel attribution strategy (see attribution.STRATEGIES) and lookback for "plurality"
+ATTRIBUTION = os.environ.get("PRW_ATTRIBUTION", "first")
+ATTRIBUTION_MONTHS = int(
+    os.environ.get("PRW_ATTRIBUTION_MONTHS", str(attribution.DEFAULT_MONTHS))
+)
+
+# Directory to also write an Arrow snapshot of the output tables to, for fast app loading
+SNAPSHOT_DIR = os.environ.get("PANEL_SNAPSHOT_DIR")
+
+# Low-cardinality string columns stored dictionary encoded in snapshots
+SNAPSHOT_DICTIONARY_COLUMNS = {
+    "patients": [
+        "sex",
+        "age_display",
+        "location",
+        "pcp",
+        "panel_location",
+        "panel_provider",
+    ],
+    "encounters": [
+        "location",
+        "encounter_type",
+        "service_provider",
+        "level_of_service",
+    ],
+}
+
+# Snapshot row order. Encounters are sorted by patient, which lets the app index each
+# patient's encounters as a slice of the memory mapped file without copying it.
+SNAPSHOT_ORDER_BY = {
+    "encounters": "mrn, encounter_date",
+}
+
+# Incremental ingest: a full reconcile is forced when the last one is older than this
+FULL_INGEST_DAYS = int(os.environ.get("PRW_FULL_INGEST_DAYS", "7"))
+
+# Last-modified column of prw_patients. Patient rows change in place (eg. age, pcp, city),
+# so an identity column would miss changes. --incremental requires this to be set.
+PATIENTS_MODIFIED_COLUMN = os.environ.get("PRW_PATIENTS_MODIFIED_COLUMN")
+
+# Monotonically increasing column used as the high-water mark of each source table.
+# Encounters are only appended, so their identity column picks up all new rows.
+WATERMARK_COLUMNS = {"prw_encounters": "id"}
+if PATIENTS_MODIFIED_COLUMN:
+    WATERMARK_COLUMNS["prw_patients"] = PATIENTS_MODIFIED_COLUMN
+
+# Max number of bound parameters per IN (...) clause (MSSQL allows ~2100 per statement)
+IN_CLAUSE_BATCH = 1000
+
 
 # -------------------------------------------------------
 # Types
@@ -29,27 +94,160 @@ PANEL_DB_ODBC = os.environ.get("PANEL_DB_ODBC", "sqlite:///panel.sqlite3")
 class SrcData:
     patients_df: pd.DataFrame
     encounters_df: pd.DataFrame
+    # Attributed provider per patient. Only set when encounters_df is not the full
+    # history (incremental ingest), otherwise transform() derives it from encounters_df.
+    panel_providers: pd.DataFrame = None
 
 
 @dataclass
 class OutData:
-    patients_df: pd.DataFrame
-    encounters_df: pd.DataFrame
+    # Either whole tables, or generators of chunks when streaming
+    patients_df: pd.DataFrame | Iterator[pd.DataFrame]
+    encounters_df: pd.DataFrame | Iterator[pd.DataFrame]
 
 
 # -------------------------------------------------------
 # Extract
 # -------------------------------------------------------
-def read_source_tables(engine) -> SrcData:
+def read_source_tables(engine, parallel: bool = False) -> SrcData:
     """
-    Read source tables from the warehouse DB
+    Read source tables from the warehouse DB. If parallel is True, tables are read
+    concurrently so total time is bounded by the slowest table rather than the sum.
     """
     logging.info("Reading source tables")
-    with Session(engine) as session:
-        patients_df = pd.read_sql_table("prw_patients", session.bind)
-        encounters_df = pd.read_sql_table("prw_encounters", session.bind)
+    tables = ["prw_patients", "prw_encounters"]
+    if parallel:
+        with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+            dfs = executor.map(lambda table: read_source_table(engine, table), tables)
+            dfs = dict(zip(tables, dfs))
+    else:
+        dfs = {table: read_source_table(engine, table) for table in tables}
+
+    return SrcData(patients_df=dfs["prw_patients"], encounters_df=dfs["prw_encounters"])
 
-    return SrcData(patients_df=patients_df, encounters_df=encounters_df)
+
+def read_source_table(engine, table: str) -> pd.DataFrame:
+    """
+    Read one source table over its own connection from the engine's pool
+    """
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        df = pd.read_sql_table(table, conn)
+    logging.info(
+        f"Read {len(df)} rows from {table} in {time.perf_counter() - start:.2f}s"
+    )
+    return df
+
+
+def read_source_chunks(
+    engine, table: str, chunksize: int, columns: list[str] = None
+) -> Iterator[pd.DataFrame]:
+    """
+    Stream a source table from the warehouse DB as dataframes of at most chunksize rows
+    """
+    logging.info(f"Streaming source table: {table}")
+    with engine.connect().execution_options(stream_results=True) as conn:
+        yield from pd.read_sql_table(table, conn, columns=columns, chunksize=chunksize)
+
+
+def read_source_watermarks(engine) -> dict:
+    """
+    Return the current high-water mark of each source table in WATERMARK_COLUMNS
+    """
+    watermarks = {}
+    with engine.connect() as conn:
+        for table, column in WATERMARK_COLUMNS.items():
+            watermarks[table] = conn.execute(
+                text(f"select max({column}) from {table}")
+            ).scalar()
+    return watermarks
+
+
+def read_source_delta(
+    engine, since: dict, until: dict, strategy: attribution.Strategy
+) -> SrcData:
+    """
+    Read source rows added or changed since the last ingest, ie. with a watermark column in
+    the range (since, until]. Patients with new encounters are re-read too, since their
+    panel assignment may change. Rows deleted from the warehouse are not detected, and
+    are only removed by the next full ingest.
+    """
+    logging.info("Reading source table changes")
+
+    def read_range(conn, table):
+        column = WATERMARK_COLUMNS[table]
+        if until[table] is None:
+            return pd.read_sql(text(f"select * from {table} where 1 = 0"), conn)
+        if since[table] is None:
+            # Table was empty at the last ingest
+            return pd.read_sql(
+                text(f"select * from {table} where {column} <= :until"),
+                conn,
+                params={"until": until[table]},
+            )
+        return pd.read_sql(
+            text(
+                f"select * from {table} where {column} > :since and {column} <= :until"
+            ),
+            conn,
+            params={"since": since[table], "until": until[table]},
+        )
+
+    with engine.connect() as conn:
+        encounters_df = read_range(conn, "prw_encounters")
+        patients_df = read_range(conn, "prw_patients")
+
+        # Re-read all patients that have new encounters, and the full encounter history
+        # needed to recompute their panel attribution
+        prw_ids = pd.concat([patients_df["prw_id"], encounters_df["prw_id"]]).unique()
+        patients_df = read_where_in(conn, "prw_patients", "prw_id", prw_ids)
+        history_df = read_where_in(
+            conn, "prw_encounters", "prw_id", prw_ids, ", ".join(strategy.columns)
+        )
+
+    logging.info(
+        f"Changed rows: {len(patients_df)} patients, {len(encounters_df)} encounters"
+    )
+    return SrcData(
+        patients_df=patients_df,
+        encounters_df=encounters_df,
+        panel_providers=attribution.attribute(history_df, strategy),
+    )
+
+
+def read_where_in(conn, table: str, column: str, values, columns="*") -> pd.DataFrame:
+    """
+    Read rows from table where column is in values, in batches of IN_CLAUSE_BATCH
+    """
+    query = text(f"select {columns} from {table} where {column} in :values").bindparams(
+        bindparam("values", expanding=True)
+    )
+    values = [v.item() if hasattr(v, "item") else v for v in values]
+    dfs = [
+        pd.read_sql(query, conn, params={"values": values[i : i + IN_CLAUSE_BATCH]})
+        for i in range(0, len(values), IN_CLAUSE_BATCH)
+    ]
+    if len(dfs) == 0:
+        return pd.read_sql(text(f"select {columns} from {table} where 1 = 0"), conn)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def needs_full_ingest(watermarks: dict, full_ingest_days: int) -> bool:
+    """
+    Return True if an incremental ingest is not possible from the stored watermarks, or
+    the last full reconcile is older than full_ingest_days
+    """
+    if any(watermarks.get(table) is None for table in WATERMARK_COLUMNS):
+        logging.info("No watermarks in output DB, running full ingest")
+        return True
+    if any(wm.column != WATERMARK_COLUMNS[t] for t, wm in watermarks.items()):
+        logging.info("Watermark columns changed, running full ingest")
+        return True
+    last_full = min(wm.full_ingest for wm in watermarks.values())
+    if datetime.now() - last_full > timedelta(days=full_ingest_days):
+        logging.info(f"Last full ingest was {last_full}, running full ingest")
+        return True
+    return False
 
 
 # -------------------------------------------------------
@@ -102,40 +300,98 @@ CLINIC_IDS = {
     "CC WPL PALOUSE PEDIATRICS PULLMAN": "Palouse Pediatrics",
     "CC WPL PALOUSE PEDIATRICS MOSCOW": "Palouse Pediatrics",
 }
+PROVIDER_TO_CLINIC = {
+    provider: CLINIC_IDS.get(location)
+    for provider, location in PROVIDER_TO_LOCATION.items()
+}
+
+# Trailing " [id]" in provider and encounter type names, and first int in level of service
+BRACKETED_RE = re.compile(r"\s*\[.*?\]\s*")
+FIRST_INT_RE = re.compile(r"(\d+)")
 
 
-def transform(src: SrcData) -> OutData:
+def transform(
+    src: SrcData,
+    workers: int = 1,
+    strategy: attribution.Strategy = attribution.FirstEncounter(),
+) -> OutData:
     """
-    Transform source data into panel data
+    Transform source data into panel data. If workers > 1, the encounters table is split
+    into partitions that are transformed in parallel processes.
     """
     logging.info("Transforming data")
-    # Patients
-    patients_df = src.patients_df.copy()
+    panel_providers = (
+        src.panel_providers
+        if src.panel_providers is not None
+        else attribution.attribute(src.encounters_df, strategy)
+    )
+    patients_df = transform_patients(src.patients_df, panel_providers)
+    if workers > 1 and len(src.encounters_df) > workers:
+        encounters_df = transform_encounters_parallel(src.encounters_df, workers)
+    else:
+        encounters_df = transform_encounters(src.encounters_df)
+    return OutData(patients_df=patients_df, encounters_df=encounters_df)
 
-    # age (floor of age in years) and age_in_mo (if < 2 years old)
-    patients_df["age_display"] = patients_df.apply(
-        lambda row: f"{int(row['age_in_mo'])}m" if row["age"] < 2 else str(row["age"]),
-        axis=1,
+
+def transform_chunked(
+    engine,
+    chunksize: int,
+    strategy: attribution.Strategy = attribution.FirstEncounter(),
+) -> OutData:
+    """
+    Streaming version of read_source_tables() + transform(). Returns generators that read and
+    transform one chunk at a time as they are consumed, so peak memory is bounded by chunksize.
+    """
+    logging.info(f"Transforming data in chunks of {chunksize} rows")
+
+    # Panel attribution needs a global view of each patient's encounters. Make one pass
+    # over just the needed columns before streaming the full tables.
+    panel_providers = attribution.attribute_chunked(
+        read_source_chunks(
+            engine, "prw_encounters", chunksize, columns=strategy.columns
+        ),
+        strategy,
+    )
+    patients = (
+        transform_patients(chunk, panel_providers)
+        for chunk in read_source_chunks(engine, "prw_patients", chunksize)
+    )
+    encounters = (
+        transform_encounters(chunk)
+        for chunk in read_source_chunks(engine, "prw_encounters", chunksize)
     )
+    return OutData(patients_df=patients, encounters_df=encounters)
+
+
+def transform_patients(
+    patients_df: pd.DataFrame, panel_providers: pd.DataFrame
+) -> pd.DataFrame:
+    """
+    Transform source patients (whole table or a chunk). panel_providers is the output of
+    attribution.attribute() over the whole encounters table.
+    """
+    patients_df = patients_df.copy()
+
+    # age (floor of age in years) and age_in_mo (if < 2 years old)
+    infants = (patients_df["age"] < 2).to_numpy()
+    age_display = patients_df["age"].astype(str).to_numpy(dtype=object)
+    age_display[infants] = (
+        patients_df.loc[infants, "age_in_mo"].astype(int).astype(str) + "m"
+    ).to_numpy(dtype=object)
+    patients_df["age_display"] = age_display
 
     # Combine city and state into location column
     patients_df["city"] = patients_df["city"].str.title()
     patients_df["state"] = patients_df["state"].str.upper()
     patients_df["location"] = patients_df["city"] + ", " + patients_df["state"]
 
-    # For now, we're just going to assign the panel location based on the provider of the first encounter in the list
-    first_encounters = (
-        src.encounters_df.groupby("prw_id")["service_provider"].first().reset_index()
-    )
+    # Assign the panel location based on the provider chosen by the attribution strategy
     patients_df = patients_df.merge(
-        first_encounters, on="prw_id", how="left", suffixes=("", "_first")
+        panel_providers, on="prw_id", how="left", suffixes=("", "_attributed")
     )
-    patients_df["panel_location"] = (
-        patients_df["service_provider"]
-        .str.split("\n")
-        .str[0]
-        .map(PROVIDER_TO_LOCATION)
-        .map(CLINIC_IDS)
+    patients_df["panel_location"] = map_distinct(
+        patients_df["service_provider"],
+        lambda providers: providers.str.split("\n").str[0].map(PROVIDER_TO_CLINIC),
     )
 
     # And, just copy pcp as the paneled provider
@@ -151,29 +407,41 @@ def transform(src: SrcData) -> OutData:
         ],
         inplace=True,
     )
+    if PATIENTS_MODIFIED_COLUMN in patients_df:
+        patients_df.drop(columns=[PATIENTS_MODIFIED_COLUMN], inplace=True)
+
+    return patients_df
+
 
-    # Encounters
-    encounters_df = src.encounters_df.copy()
+def transform_encounters(encounters_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Transform source encounters (whole table or a chunk)
+    """
+    encounters_df = encounters_df.copy()
 
     # Force date columns to be date only, no time
     encounters_df["encounter_date"] = pd.to_datetime(
         encounters_df["encounter_date"]
     ).dt.date
 
+    # These columns have few distinct values, so each mapping or regex is applied once per
+    # distinct value rather than once per row
     # Map encounter location to clinic IDs
-    encounters_df["location"] = encounters_df["location"].map(CLINIC_IDS)
+    encounters_df["location"] = map_distinct(
+        encounters_df["location"], lambda locations: locations.map(CLINIC_IDS)
+    )
 
     # Remove anything in trailing [] using a regex in the "service_provider" and "type" columns
-    encounters_df["service_provider"] = encounters_df["service_provider"].str.replace(
-        r"\s*\[.*?\]\s*", "", regex=True
-    )
-    encounters_df["encounter_type"] = encounters_df["encounter_type"].str.replace(
-        r"\s*\[.*?\]\s*", "", regex=True
-    )
+    for col in ["service_provider", "encounter_type"]:
+        encounters_df[col] = map_distinct(
+            encounters_df[col],
+            lambda values: values.str.replace(BRACKETED_RE, "", regex=True),
+        )
 
     # Rewrite level_of_service values to retain only the first int
-    encounters_df["level_of_service"] = encounters_df["level_of_service"].str.extract(
-        r"(\d+)"
+    encounters_df["level_of_service"] = map_distinct(
+        encounters_df["level_of_service"],
+        lambda values: values.str.extract(FIRST_INT_RE)[0],
     )
 
     # Delete unused columns: dept, encounter_time, billing_provider, appt_status
@@ -187,7 +455,38 @@ def transform(src: SrcData) -> OutData:
         inplace=True,
     )
 
-    return OutData(patients_df=patients_df, encounters_df=encounters_df)
+    return encounters_df
+
+
+def transform_encounters_parallel(
+    encounters_df: pd.DataFrame, workers: int
+) -> pd.DataFrame:
+    """
+    Run transform_encounters() over row partitions of encounters_df in worker processes
+    """
+    logging.info(f"Transforming encounters in {workers} processes")
+    bounds = np.linspace(0, len(encounters_df), workers + 1, dtype=int)
+    partitions = [
+        encounters_df.iloc[start:end] for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return pd.concat(executor.map(transform_encounters, partitions))
+
+
+def map_distinct(values: pd.Series, fn) -> pd.Series:
+    """
+    Equivalent to fn(values) for an element-wise fn over a string column, but fn is only
+    applied to the distinct values, which are then expanded back to every row
+    """
+    codes, uniques = pd.factorize(values)
+    mapped = fn(pd.Series(uniques, dtype=object)).to_numpy(dtype=object)
+    ret = np.append(mapped, None)[codes]
+
+    # Missing values (code -1) go through fn as-is, so None vs NaN results match fn(values)
+    missing = codes == -1
+    if missing.any():
+        ret[missing] = fn(values[missing]).to_numpy(dtype=object)
+    return pd.Series(ret, index=values.index, dtype=object)
 
 
 # -------------------------------------------------------
@@ -215,6 +514,57 @@ def parse_arguments():
         help="Output DB connection string, including credentials",
         default=PANEL_DB_ODBC,
     )
+    parser.add_argument(
+        "-c",
+        "--chunksize",
+        help="Stream source tables in chunks of this many rows to bound memory use. 0 reads whole tables into memory.",
+        type=int,
+        default=CHUNKSIZE,
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only ingest source rows added or changed since the last run, and upsert them into the output DB. Requires PRW_PATIENTS_MODIFIED_COLUMN. Falls back to a full ingest when there are no watermarks from a previous run or the last full ingest is too old.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full-ingest-days",
+        help="With --incremental, force a full ingest if the last one is older than this many days",
+        type=int,
+        default=FULL_INGEST_DAYS,
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="Number of processes used to transform encounters when not streaming in chunks",
+        type=int,
+        default=TRANSFORM_WORKERS,
+    )
+    parser.add_argument(
+        "-p",
+        "--parallel-extract",
+        help="Read source tables concurrently when not streaming in chunks",
+        action="store_true",
+        default=PARALLEL_EXTRACT,
+    )
+    parser.add_argument(
+        "-a",
+        "--attribution",
+        help="How patients are assigned a panel provider from their encounters: first encounter, most recent encounter, or most frequent provider over --attribution-months",
+        choices=attribution.STRATEGIES.keys(),
+        default=ATTRIBUTION,
+    )
+    parser.add_argument(
+        "--attribution-months",
+        help="Lookback window for --attribution plurality",
+        type=int,
+        default=ATTRIBUTION_MONTHS,
+    )
+    parser.add_argument(
+        "-s",
+        "--snapshot",
+        help="Also write an Arrow IPC snapshot of the output tables to this directory",
+        default=SNAPSHOT_DIR,
+    )
     return parser.parse_args()
 
 
@@ -228,38 +578,164 @@ def main():
     output_odbc = args.output
     logging.info(f"Input: {input_odbc}, output: {util.mask_pw(output_odbc)}")
 
+    strategy = attribution.get_strategy(args.attribution, args.attribution_months)
+
     # Get connection to input DB
     in_engine = util.get_db_connection(input_odbc)
     if in_engine is None:
         error_exit("ERROR: cannot open warehouse DB (see above)")
 
-    # Extract source tables into memory
-    src = read_source_tables(in_engine)
-    if src is None:
-        error_exit("ERROR: failed to read source data (see above)")
-
-    # Transform data
-    out = transform(src)
-
     # Get connection to output DB
     out_engine = util.get_db_connection(output_odbc)
     if out_engine is None:
         error_exit("ERROR: cannot open output DB (see above)")
 
-    # Create tables if they do not exist
+    # Create tables if they do not exist, and add new columns to the run history
     SQLModel.metadata.create_all(out_engine)
-
-    # Write into DB
-    util.write_tables_to_db(
-        out_engine,
-        [
-            util.TableData(table=panel_model.Patient, df=out.patients_df),
-            util.TableData(table=panel_model.Encounter, df=out.encounters_df),
-        ],
-    )
-
-    # Update last ingest time and modified times for source data files
-    util.write_meta(out_engine, panel_model.Meta)
+    util.add_missing_columns(out_engine, panel_model.IngestRun)
+
+    # Resource use of each stage, saved to the ingest_runs table at the end
+    run_started = datetime.now()
+    stats = []
+    tables = [panel_model.Patient, panel_model.Encounter]
+
+    # Use stored watermarks to decide if we can ingest only changes since the last run.
+    # Read current source watermarks before extracting, so any rows added during the
+    # ingest are picked up again by the next run.
+    full_ingest = True
+    if args.incremental and "prw_patients" not in WATERMARK_COLUMNS:
+        error_exit(
+            "ERROR: --incremental requires PRW_PATIENTS_MODIFIED_COLUMN, the last-modified "
+            "column of prw_patients, so changed patient rows are picked up"
+        )
+    if args.incremental:
+        prev_watermarks = util.read_watermarks(out_engine, panel_model.Watermark)
+        full_ingest = needs_full_ingest(prev_watermarks, args.full_ingest_days)
+    watermarks = read_source_watermarks(in_engine)
+
+    # Stages are run in a try so the stats of a failed run, including the stage that
+    # failed, are still saved
+    try:
+        if not full_ingest:
+            mode = "incremental"
+
+            # Extract and transform changed source rows, then upsert them
+            with util.measure_stage("extract", stats) as stage:
+                src = read_source_delta(
+                    in_engine,
+                    {table: wm.value for table, wm in prev_watermarks.items()},
+                    watermarks,
+                    strategy,
+                )
+                stage.rows_out = len(src.patients_df) + len(src.encounters_df)
+
+            with util.measure_stage("transform", stats) as stage:
+                stage.rows_in = len(src.patients_df) + len(src.encounters_df)
+                out = transform(src, strategy=strategy)
+                stage.rows_out = len(out.patients_df) + len(out.encounters_df)
+
+            with util.measure_stage("write", stats) as stage:
+                stage.rows_in = len(out.patients_df) + len(out.encounters_df)
+                stage.rows_out = util.upsert_tables_to_db(
+                    out_engine,
+                    [
+                        util.TableData(table=panel_model.Patient, df=out.patients_df),
+                        util.TableData(
+                            table=panel_model.Encounter, df=out.encounters_df
+                        ),
+                    ],
+                )
+                util.analyze_tables(out_engine, tables)
+            full_ingest_time = min(wm.full_ingest for wm in prev_watermarks.values())
+
+        elif args.chunksize > 0:
+            mode = "full_chunked"
+
+            # Extract and transform lazily, one chunk at a time, as data is written to the output DB
+            with util.measure_stage("extract_transform_write", stats) as stage:
+                out = transform_chunked(in_engine, args.chunksize, strategy)
+                stage.rows_out = util.write_tables_to_db(
+                    out_engine,
+                    [
+                        util.TableData(table=panel_model.Patient, df=out.patients_df),
+                        util.TableData(
+                            table=panel_model.Encounter, df=out.encounters_df
+                        ),
+                    ],
+                )
+                util.analyze_tables(out_engine, tables)
+            full_ingest_time = run_started
+
+        else:
+            mode = "full"
+
+            # Extract source tables into memory
+            with util.measure_stage("extract", stats) as stage:
+                src = read_source_tables(in_engine, args.parallel_extract)
+                if src is None:
+                    error_exit("ERROR: failed to read source data (see above)")
+                stage.rows_out = len(src.patients_df) + len(src.encounters_df)
+
+            # Transform data
+            with util.measure_stage("transform", stats) as stage:
+                stage.rows_in = len(src.patients_df) + len(src.encounters_df)
+                out = transform(src, args.workers, strategy)
+                stage.rows_out = len(out.patients_df) + len(out.encounters_df)
+                del src
+
+            # Write into DB and refresh query planner statistics for the new data
+            with util.measure_stage("write", stats) as stage:
+                stage.rows_in = len(out.patients_df) + len(out.encounters_df)
+                stage.rows_out = util.write_tables_to_db(
+                    out_engine,
+                    [
+                        util.TableData(table=panel_model.Patient, df=out.patients_df),
+                        util.TableData(
+                            table=panel_model.Encounter, df=out.encounters_df
+                        ),
+                    ],
+                )
+                util.analyze_tables(out_engine, tables)
+            full_ingest_time = run_started
+
+        with util.measure_stage("meta", stats):
+            # Save source watermarks for the next incremental ingest
+            util.write_watermarks(
+                out_engine,
+                panel_model.Watermark,
+                {
+                    table: (WATERMARK_COLUMNS[table], wm)
+                    for table, wm in watermarks.items()
+                },
+                full_ingest_time,
+            )
+
+            # Update last ingest time and modified times for source data files
+            util.write_meta(out_engine, panel_model.Meta)
+
+        # Write columnar snapshot of the output tables
+        if args.snapshot:
+            with util.measure_stage("snapshot", stats):
+                os.makedirs(args.snapshot, exist_ok=True)
+                with out_engine.connect() as conn:
+                    modified = conn.execute(
+                        text("select max(modified) from meta")
+                    ).scalar()
+                for table in tables:
+                    util.write_snapshot(
+                        out_engine,
+                        table,
+                        os.path.join(args.snapshot, f"{table.__tablename__}.arrow"),
+                        SNAPSHOT_DICTIONARY_COLUMNS[table.__tablename__],
+                        {"modified": str(modified)},
+                        SNAPSHOT_ORDER_BY.get(table.__tablename__),
+                    )
+    finally:
+        # Save resource use of this run
+        if stats:
+            util.write_ingest_stats(
+                out_engine, panel_model.IngestRun, run_started, mode, stats
+            )
 
     # Cleanup
     in_engine.dispose()
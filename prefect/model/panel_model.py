@@ -1,3 +1,4 @@
+from sqlalchemy import Index
 from sqlmodel import Field, SQLModel, Relationship
 from typing import List, Optional
 from datetime import date, datetime
@@ -9,13 +10,47 @@ class Meta(SQLModel, table=True):
     modified: datetime
 
 
+class Watermark(SQLModel, table=True):
+    """High-water mark of a warehouse table as of the last ingest, for incremental ingest"""
+
+    __tablename__ = "meta_watermarks"
+    source_table: str = Field(primary_key=True)
+    column: str
+    value: Optional[str] = None
+    # Time of the last full (non-incremental) ingest that reconciled the whole table
+    full_ingest: datetime
+
+
+class IngestRun(SQLModel, table=True):
+    """Resource use of each stage of each ingest run, kept as history across runs"""
+
+    __tablename__ = "ingest_runs"
+    id: Optional[int] = Field(default=None, primary_key=True)
+    run_started: datetime = Field(index=True)
+    mode: str
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    peak_rss_mb: Optional[float] = None
+    # True if the stage raised, ending the run
+    error: Optional[bool] = None
+
+
 class Patient(SQLModel, table=True):
     __tablename__ = "patients"
+    __table_args__ = (
+        # Per-clinic patient lists and demographic counts without reading the table
+        Index("ix_patients_panel_location", "panel_location", "sex", "age", "location"),
+        Index("ix_patients_mrn", "mrn"),
+    )
 
     prw_id: Optional[int] = Field(default=None, primary_key=True)
+    mrn: Optional[str] = None
     sex: str = Field(regex="^[MFO]$")
     age: Optional[int] = Field(ge=0)
-    age_mo: Optional[int] = Field(ge=0)
+    age_in_mo: Optional[int] = Field(ge=0)
     age_display: Optional[str] = None
     location: Optional[str] = None
     pcp: Optional[str] = None
@@ -27,9 +62,17 @@ class Patient(SQLModel, table=True):
 
 class Encounter(SQLModel, table=True):
     __tablename__ = "encounters"
+    __table_args__ = (
+        # Per-patient encounter lookups, already in date order
+        Index("ix_encounters_prw_id_date", "prw_id", "encounter_date"),
+        Index("ix_encounters_mrn_date", "mrn", "encounter_date"),
+        # Date range scans
+        Index("ix_encounters_encounter_date", "encounter_date"),
+    )
 
     id: Optional[int] = Field(default=None, primary_key=True)
     prw_id: int = Field(foreign_key="patients.prw_id")
+    mrn: Optional[str] = None
     location: str
     encounter_date: date
     encounter_type: str
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Ingest modules import each other as top level modules, as when run from prefect/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
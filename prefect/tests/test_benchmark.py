@@ -0,0 +1,24 @@
+import os
+import multiprocessing as mp
+import benchmark
+
+
+def test_wait_for_result_returns_none_when_child_dies():
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=os._exit, args=(3,))
+    proc.start()
+
+    assert benchmark.wait_for_result(proc, queue) is None
+    assert proc.exitcode == 3
+
+
+def test_wait_for_result_returns_result():
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    queue.put({"total_seconds": 1})
+    proc = ctx.Process(target=os._exit, args=(0,))
+    proc.start()
+
+    assert benchmark.wait_for_result(proc, queue) == {"total_seconds": 1}
+    assert proc.exitcode == 0
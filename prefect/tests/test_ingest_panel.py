@@ -0,0 +1,202 @@
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from sqlalchemy import text
+from util import util
+import attribution
+import benchmark
+import ingest_panel
+
+
+def baseline_transform(src: ingest_panel.SrcData) -> ingest_panel.OutData:
+    """
+    transform() as it was before it was vectorized, used as the reference output
+    """
+    patients_df = src.patients_df.copy()
+    patients_df["age_display"] = patients_df.apply(
+        lambda row: f"{int(row['age_in_mo'])}m" if row["age"] < 2 else str(row["age"]),
+        axis=1,
+    )
+    patients_df["city"] = patients_df["city"].str.title()
+    patients_df["state"] = patients_df["state"].str.upper()
+    patients_df["location"] = patients_df["city"] + ", " + patients_df["state"]
+    first_encounters = (
+        src.encounters_df.groupby("prw_id")["service_provider"].first().reset_index()
+    )
+    patients_df = patients_df.merge(
+        first_encounters, on="prw_id", how="left", suffixes=("", "_first")
+    )
+    patients_df["panel_location"] = (
+        patients_df["service_provider"]
+        .str.split("\n")
+        .str[0]
+        .map(ingest_panel.PROVIDER_TO_LOCATION)
+        .map(ingest_panel.CLINIC_IDS)
+    )
+    patients_df["panel_provider"] = patients_df["pcp"]
+    patients_df.drop(columns=["id", "service_provider", "city", "state"], inplace=True)
+
+    encounters_df = src.encounters_df.copy()
+    encounters_df["encounter_date"] = pd.to_datetime(
+        encounters_df["encounter_date"]
+    ).dt.date
+    encounters_df["location"] = encounters_df["location"].map(ingest_panel.CLINIC_IDS)
+    encounters_df["service_provider"] = encounters_df["service_provider"].str.replace(
+        r"\s*\[.*?\]\s*", "", regex=True
+    )
+    encounters_df["encounter_type"] = encounters_df["encounter_type"].str.replace(
+        r"\s*\[.*?\]\s*", "", regex=True
+    )
+    encounters_df["level_of_service"] = encounters_df["level_of_service"].str.extract(
+        r"(\d+)"
+    )
+    encounters_df.drop(
+        columns=["dept", "encounter_time", "billing_provider", "appt_status"],
+        inplace=True,
+    )
+    return ingest_panel.OutData(patients_df=patients_df, encounters_df=encounters_df)
+
+
+def synthetic_src(n_patients=200, n_encounters=2000, seed=0) -> ingest_panel.SrcData:
+    """
+    Synthetic source tables with missing values in the mapped string columns, as None
+    and NaN, and some patients with no encounters
+    """
+    rng = np.random.default_rng(seed)
+    patients_df = benchmark.generate_patients(rng, 0, n_patients)
+    encounters_df = benchmark.generate_encounters(rng, 0, n_encounters, n_patients - 20)
+    patients_df["city"] = patients_df["city"].astype(object)
+    patients_df.loc[rng.random(n_patients) < 0.05, "city"] = None
+
+    for column in [
+        "location",
+        "service_provider",
+        "encounter_type",
+        "level_of_service",
+    ]:
+        values = encounters_df[column].astype(object)
+        values[rng.random(n_encounters) < 0.05] = None
+        values[rng.random(n_encounters) < 0.05] = np.nan
+        encounters_df[column] = values
+    # Unknown locations and providers, which map to missing values
+    encounters_df.loc[rng.random(n_encounters) < 0.05, "location"] = "UNKNOWN CLINIC"
+    encounters_df.loc[rng.random(n_encounters) < 0.05, "service_provider"] = (
+        "Nobody [1]"
+    )
+    return ingest_panel.SrcData(patients_df=patients_df, encounters_df=encounters_df)
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_transform_matches_baseline(workers):
+    src = synthetic_src()
+    expected = baseline_transform(src)
+    out = ingest_panel.transform(src, workers, attribution.FirstEncounter())
+
+    pd.testing.assert_frame_equal(out.patients_df, expected.patients_df)
+    pd.testing.assert_frame_equal(out.encounters_df, expected.encounters_df)
+
+
+def test_map_distinct_matches_elementwise():
+    values = pd.Series(["a [1]", None, "b [2]", np.nan, "a [1]", "c"], dtype=object)
+    fn = lambda v: v.str.replace(ingest_panel.BRACKETED_RE, "", regex=True)
+
+    pd.testing.assert_series_equal(ingest_panel.map_distinct(values, fn), fn(values))
+
+
+@pytest.fixture
+def incremental(monkeypatch):
+    """
+    Configure incremental ingest with prw_patients.modified as the patients watermark
+    """
+    monkeypatch.setattr(ingest_panel, "PATIENTS_MODIFIED_COLUMN", "modified")
+    monkeypatch.setattr(
+        ingest_panel,
+        "WATERMARK_COLUMNS",
+        {"prw_encounters": "id", "prw_patients": "modified"},
+    )
+
+
+def run_ingest(monkeypatch, prw_path, panel_path, *args):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "ingest_panel.py",
+            "-i",
+            f"sqlite:///{prw_path}",
+            "-o",
+            f"sqlite:///{panel_path}",
+        ]
+        + list(args),
+    )
+    ingest_panel.main()
+
+
+def read_panel(panel_path) -> dict[str, pd.DataFrame]:
+    engine = util.get_db_connection(f"sqlite:///{panel_path}")
+    with engine.connect() as conn:
+        tables = {
+            "patients": pd.read_sql("select * from patients order by prw_id", conn),
+            "encounters": pd.read_sql("select * from encounters order by id", conn),
+            "modes": pd.read_sql(
+                "select distinct run_started, mode from ingest_runs", conn
+            ),
+        }
+    engine.dispose()
+    return tables
+
+
+def test_incremental_ingest_matches_full_ingest(tmp_path, monkeypatch, incremental):
+    prw_path = tmp_path / "prw.sqlite3"
+    engine = util.get_db_connection(f"sqlite:///{prw_path}")
+    benchmark.generate_warehouse(engine, 2000)
+    with engine.begin() as conn:
+        conn.execute(text("alter table prw_patients add column modified timestamp"))
+        conn.execute(text("update prw_patients set modified = '2024-01-01 00:00:00'"))
+
+    panel_path = tmp_path / "panel.sqlite3"
+    run_ingest(monkeypatch, prw_path, panel_path, "--incremental")
+
+    # Change patients in place, and add a patient and encounters for new and existing
+    # patients
+    rng = np.random.default_rng(1)
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "update prw_patients set age = age + 1, city = 'moscow',"
+                " modified = '2024-02-01 00:00:00' where prw_id in (3, 5, 7)"
+            )
+        )
+        patient = benchmark.generate_patients(rng, 200, 1)
+        patient["modified"] = "2024-02-01 00:00:00"
+        patient.to_sql("prw_patients", conn, if_exists="append", index=False)
+        benchmark.generate_encounters(rng, 2000, 50, 201).to_sql(
+            "prw_encounters", conn, if_exists="append", index=False
+        )
+    engine.dispose()
+
+    run_ingest(monkeypatch, prw_path, panel_path, "--incremental")
+    full_path = tmp_path / "full.sqlite3"
+    run_ingest(monkeypatch, prw_path, full_path)
+
+    incremental_panel, full_panel = read_panel(panel_path), read_panel(full_path)
+    assert incremental_panel["modes"]["mode"].tolist() == ["full", "incremental"]
+    assert_frame_equal(incremental_panel["patients"], full_panel["patients"])
+    assert_frame_equal(incremental_panel["encounters"], full_panel["encounters"])
+    assert incremental_panel["patients"].loc[3, "location"].startswith("Moscow")
+    assert len(incremental_panel["patients"]) == 201
+
+
+def test_incremental_requires_patients_modified_column(tmp_path, monkeypatch):
+    monkeypatch.setattr(ingest_panel, "WATERMARK_COLUMNS", {"prw_encounters": "id"})
+
+    with pytest.raises(SystemExit) as exit_info:
+        run_ingest(
+            monkeypatch,
+            tmp_path / "prw.sqlite3",
+            tmp_path / "panel.sqlite3",
+            "--incremental",
+        )
+    assert exit_info.value.code == 1
@@ -0,0 +1,163 @@
+import pandas as pd
+import pytest
+from datetime import date
+from sqlalchemy import inspect
+from sqlmodel import SQLModel
+from model import panel_model
+from util import util
+
+
+def patients(n: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "prw_id": range(n),
+            "mrn": [str(100000 + i) for i in range(n)],
+            "sex": "F",
+            "age": 30,
+            "age_in_mo": 360,
+            "age_display": "30",
+            "location": "Pullman, WA",
+            "pcp": "Pcp",
+            "panel_location": "Residency",
+            "panel_provider": "Pcp",
+        }
+    )
+
+
+def encounters(n: int) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "id": range(n),
+            "prw_id": [i % 3 for i in range(n)],
+            "mrn": [str(100000 + i % 3) for i in range(n)],
+            "location": "Residency",
+            "encounter_date": date(2024, 1, 1),
+            "encounter_type": "Office Visit",
+            "service_provider": "Provider",
+            "with_pcp": True,
+            "diagnoses": None,
+            "level_of_service": "99213",
+        }
+    )
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = util.get_db_connection(f"sqlite:///{tmp_path / 'panel.sqlite3'}")
+    SQLModel.metadata.create_all(engine)
+    util.write_tables_to_db(
+        engine,
+        [
+            util.TableData(table=panel_model.Patient, df=patients(3)),
+            util.TableData(table=panel_model.Encounter, df=encounters(5)),
+        ],
+    )
+    yield engine
+    engine.dispose()
+
+
+def live_state(engine) -> dict:
+    """
+    Return the row counts and index names of each table in the DB
+    """
+    inspector = inspect(engine)
+    with engine.connect() as conn:
+        return {
+            table: (
+                conn.exec_driver_sql(f"select count(*) from {table}").scalar(),
+                sorted(index["name"] for index in inspector.get_indexes(table)),
+            )
+            for table in inspector.get_table_names()
+        }
+
+
+def test_write_tables_replaces_contents(engine):
+    before = live_state(engine)
+    util.write_tables_to_db(
+        engine,
+        [
+            util.TableData(table=panel_model.Patient, df=patients(4)),
+            util.TableData(table=panel_model.Encounter, df=encounters(7)),
+        ],
+    )
+    after = live_state(engine)
+
+    assert after["patients"] == (4, before["patients"][1])
+    assert after["encounters"] == (7, before["encounters"][1])
+    assert not any(util.STAGING_SUFFIX in t or util.OLD_SUFFIX in t for t in after)
+    assert before["patients"][1] and before["encounters"][1]
+
+
+def test_failed_swap_leaves_live_tables_intact(engine):
+    before = live_state(engine)
+
+    # Load encounters, but not the patients staging table, so the swap fails on the
+    # second rename after the live patients table was renamed away
+    patients_table = panel_model.Patient.__table__
+    encounters_table = panel_model.Encounter.__table__
+    patients_staging = util.staging_table(patients_table, keep_foreign_keys=True)
+    encounters_staging = util.staging_table(encounters_table, keep_foreign_keys=True)
+    encounters_staging.create(engine)
+    with engine.begin() as conn:
+        encounters(9).to_sql(
+            encounters_staging.name, conn, if_exists="append", index=False
+        )
+
+    with pytest.raises(Exception):
+        util.swap_tables(
+            engine,
+            [
+                (patients_table, patients_staging),
+                (encounters_table, encounters_staging),
+            ],
+        )
+
+    after = live_state(engine)
+    assert after["patients"] == before["patients"]
+    assert after["encounters"] == before["encounters"]
+    assert not any(t.endswith(util.OLD_SUFFIX) for t in after)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA legacy_alter_table").scalar() == 0
+
+
+def test_bulk_load_restores_pragmas(engine):
+    with engine.connect() as conn:
+        synchronous = conn.exec_driver_sql("PRAGMA synchronous").scalar()
+    util.write_tables_to_db(
+        engine, [util.TableData(table=panel_model.Patient, df=patients(2))]
+    )
+
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == synchronous
+        assert synchronous != 0
+
+
+def test_measure_stage_records_failed_stage():
+    stats = []
+    with util.measure_stage("ok", stats) as stage:
+        stage.rows_out = 1
+    with pytest.raises(RuntimeError):
+        with util.measure_stage("failed", stats):
+            raise RuntimeError("stage failed")
+
+    assert [(s.stage, s.error) for s in stats] == [("ok", False), ("failed", True)]
+    assert stats[1].wall_seconds is not None
+
+
+def test_add_missing_columns(engine):
+    with engine.begin() as conn:
+        conn.exec_driver_sql("ALTER TABLE ingest_runs DROP COLUMN error")
+    util.add_missing_columns(engine, panel_model.IngestRun)
+    util.add_missing_columns(engine, panel_model.IngestRun)
+
+    columns = [c["name"] for c in inspect(engine).get_columns("ingest_runs")]
+    assert columns.count("error") == 1
+    util.write_ingest_stats(
+        engine,
+        panel_model.IngestRun,
+        date(2024, 1, 1),
+        "full",
+        [util.StageStats(stage="write", wall_seconds=1, cpu_seconds=1, error=True)],
+    )
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("select error from ingest_runs").scalar() == 1
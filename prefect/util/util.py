@@ -2,22 +2,66 @@
 DB Utility fFnctions
 """
 
+import os
 import re
+import sys
+import time
 import urllib
 import logging
+import resource
 import pandas as pd
+import pyarrow as pa
+from typing import Iterable
 from datetime import datetime
-from dataclasses import dataclass
-from sqlmodel import SQLModel, Session, create_engine, delete
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from sqlalchemy import MetaData, Table, inspect, types
+from sqlalchemy.schema import AddConstraint
+from sqlmodel import SQLModel, Session, create_engine, delete, select
 
 SHOW_SQL_IN_LOG = False
 
+# Rows per executemany() batch when bulk loading tables
+BULK_LOAD_BATCH = 10000
 
-# Associate a table with its data to update in a DB
+# Rows per batch when reading tables for snapshots
+SNAPSHOT_BATCH = 100000
+
+# Suffixes for tables being loaded and tables being replaced by write_tables_to_db()
+STAGING_SUFFIX = "__staging"
+OLD_SUFFIX = "__old"
+
+# Connection settings for SQLite bulk loads into staging tables. Durability is not needed
+# until the tables are swapped in, and a large page cache avoids re-reading B-tree pages
+# while inserting. Previous values are restored after the load.
+SQLITE_BULK_LOAD_PRAGMAS = {
+    "synchronous": "OFF",
+    "temp_store": "MEMORY",
+    "cache_size": "-262144",
+}
+
+# Max number of primary keys per DELETE ... IN (...) statement when upserting
+UPSERT_KEY_BATCH = 1000
+
+
+# Associate a table with its data to update in a DB. df may be a single dataframe or
+# an iterable of dataframe chunks, which are written as they are produced.
 @dataclass
 class TableData:
     table: SQLModel
-    df: pd.DataFrame
+    df: pd.DataFrame | Iterable[pd.DataFrame]
+
+
+# Resource use of one stage of an ingest run
+@dataclass
+class StageStats:
+    stage: str
+    wall_seconds: float = None
+    cpu_seconds: float = None
+    rows_in: int = None
+    rows_out: int = None
+    peak_rss_mb: float = None
+    error: bool = False
 
 
 def mask_pw(odbc_str: str) -> str:
@@ -44,9 +88,13 @@ def get_db_connection(odbc_str: str):
         # No odbc_connect= found, just original string
         conn_str = odbc_str
 
-    # Use SQLModel to establish connection to DB
+    # Use SQLModel to establish connection to DB. For MSSQL over pyodbc, send executemany()
+    # parameters as one array per batch instead of one round trip per row.
+    kwargs = {}
+    if conn_str.startswith("mssql+pyodbc"):
+        kwargs["fast_executemany"] = True
     try:
-        engine = create_engine(conn_str, echo=SHOW_SQL_IN_LOG)
+        engine = create_engine(conn_str, echo=SHOW_SQL_IN_LOG, **kwargs)
         return engine
     except Exception as e:
         logging.error(f"ERROR: failed to connect to DB")
@@ -54,21 +102,416 @@ def get_db_connection(odbc_str: str):
         return None
 
 
-def write_tables_to_db(engine, tables_data: list[TableData]) -> None:
-    """ """
+def write_tables_to_db(engine, tables_data: list[TableData]) -> int:
+    """
+    Replace the contents of each table with its data. Data is bulk loaded into staging
+    tables first, then all staging tables are swapped in for the live tables in one
+    transaction, so readers never see an empty or partially loaded table.
+    Returns the total number of rows written.
+    """
+    total_rows = 0
+    swaps = []
+    for table_data in tables_data:
+        table = table_data.table.__table__
+        staging = staging_table(
+            table, keep_foreign_keys=engine.dialect.name == "sqlite"
+        )
+        logging.info(f"Writing data to table: {table.name} (via {staging.name})")
+
+        staging.drop(engine, checkfirst=True)
+        staging.create(engine)
+        pragmas = SQLITE_BULK_LOAD_PRAGMAS if engine.dialect.name == "sqlite" else {}
+        with engine.connect() as conn, sqlite_pragmas(conn, pragmas), conn.begin():
+            chunks = (
+                [table_data.df]
+                if isinstance(table_data.df, pd.DataFrame)
+                else table_data.df
+            )
+            nrows = 0
+            for df in chunks:
+                df.to_sql(
+                    name=staging.name,
+                    con=conn,
+                    if_exists="append",
+                    index=False,
+                    chunksize=BULK_LOAD_BATCH,
+                )
+                nrows += len(df)
+        logging.info(f"Wrote {nrows} rows to {staging.name}")
+        total_rows += nrows
+        swaps.append((table, staging))
+
+    swap_tables(engine, swaps)
+    return total_rows
+
+
+@contextmanager
+def sqlite_pragmas(conn, pragmas: dict):
+    """
+    Set SQLite pragmas on conn for the enclosed block, then restore their previous values,
+    so settings such as synchronous = OFF do not outlive it on a pooled connection
+    """
+    previous = {
+        name: conn.exec_driver_sql(f"PRAGMA {name}").scalar() for name in pragmas
+    }
+    for name, value in pragmas.items():
+        conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+    conn.commit()
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            conn.exec_driver_sql(f"PRAGMA {name} = {value}")
+        conn.commit()
+
+
+def staging_table(table: Table, keep_foreign_keys: bool) -> Table:
+    """
+    Return a copy of table's schema named with STAGING_SUFFIX. Indexes are not copied
+    since index names must be unique, and are rebuilt on the live table after swapping.
+    """
+    # Copy live tables into the new metadata too, so foreign keys can resolve their targets
+    metadata = MetaData()
+    for live in table.metadata.sorted_tables:
+        live.to_metadata(metadata)
+    staging = table.to_metadata(metadata, name=table.name + STAGING_SUFFIX)
+    staging.indexes.clear()
+    # Keys come from the source data, don't let the DB generate them (eg. MSSQL IDENTITY)
+    for column in staging.primary_key.columns:
+        column.autoincrement = False
+    if not keep_foreign_keys:
+        # Most DBs bind foreign keys to the referenced table itself rather than its name,
+        # so a staging table's keys would follow the old table when it is renamed. They
+        # are re-created on the live table by swap_tables().
+        for fk in list(staging.foreign_key_constraints):
+            staging.constraints.discard(fk)
+            for column in fk.columns:
+                column.foreign_keys.clear()
+    return staging
+
+
+def swap_tables(engine, swaps: list[tuple[Table, Table]]) -> None:
+    """
+    In one transaction, replace each live table with its loaded staging table by renaming,
+    drop the old tables, and build the live tables' indexes and any foreign keys left off
+    the staging tables
+    """
+    logging.info(f"Swapping in tables: {', '.join(t.name for t, _ in swaps)}")
+    sqlite = engine.dialect.name == "sqlite"
+    if engine.dialect.name == "mssql":
+        rename = "EXEC sp_rename '{0}', '{1}'"
+    else:
+        rename = "ALTER TABLE {0} RENAME TO {1}"
+
+    with engine.connect() as conn:
+        if sqlite:
+            # Keep other tables' foreign key references pointing at the name, not the
+            # renamed table (SQLite >= 3.26 rewrites references on rename otherwise)
+            conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+            conn.commit()
+        try:
+            with conn.begin():
+                if sqlite:
+                    # pysqlite does not open a transaction for DDL, so each statement
+                    # would commit on its own. Open one explicitly, which also keeps
+                    # readers on the old tables until the swap commits.
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+                for table, staging in swaps:
+                    old_name = table.name + OLD_SUFFIX
+                    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {old_name}")
+                    conn.exec_driver_sql(rename.format(table.name, old_name))
+                    conn.exec_driver_sql(rename.format(staging.name, table.name))
+
+                # Drop in reverse order so referencing tables are dropped before
+                # referenced ones
+                for table, _ in reversed(swaps):
+                    conn.exec_driver_sql(f"DROP TABLE {table.name + OLD_SUFFIX}")
+
+                # Indexes went away with the old tables. Building them after the bulk
+                # load is faster than maintaining them during it.
+                for table, _ in swaps:
+                    for index in table.indexes:
+                        logging.info(f"Creating index {index.name}")
+                        index.create(conn, checkfirst=True)
+
+                # Staging tables that could not keep their foreign keys (see
+                # staging_table()) get them back once all referenced tables are live
+                for table, staging in swaps:
+                    if staging.foreign_key_constraints:
+                        continue
+                    for fk in table.foreign_key_constraints:
+                        logging.info(
+                            f"Creating foreign key {table.name}.{fk.column_keys}"
+                        )
+                        conn.execute(AddConstraint(fk))
+        finally:
+            if sqlite:
+                conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+                conn.commit()
+
+
+def upsert_tables_to_db(engine, tables_data: list[TableData]) -> int:
+    """
+    Insert or replace rows in each table by primary key, in a single transaction.
+    Returns the total number of rows written.
+    """
     with Session(engine) as session:
         for table_data in tables_data:
-            logging.info(f"Writing data to table: {table_data.table.__tablename__}")
+            table = table_data.table.__table__
+            logging.info(f"Upserting {len(table_data.df)} rows to table: {table.name}")
 
-            # Clear table and rewrite from dataframe
-            session.exec(delete(table_data.table))
+            # Delete existing rows with the same primary key, then append new rows
+            (pk,) = table.primary_key.columns
+            keys = table_data.df[pk.name].tolist()
+            for i in range(0, len(keys), UPSERT_KEY_BATCH):
+                session.exec(
+                    delete(table_data.table).where(
+                        pk.in_(keys[i : i + UPSERT_KEY_BATCH])
+                    )
+                )
             table_data.df.to_sql(
-                name=table_data.table.__tablename__,
+                name=table.name,
                 con=session.connection(),
                 if_exists="append",
                 index=False,
             )
         session.commit()
+    return sum(len(table_data.df) for table_data in tables_data)
+
+
+def analyze_tables(engine, tables: list[SQLModel]) -> None:
+    """
+    Refresh query planner statistics for tables after a load
+    """
+    logging.info("Updating table statistics")
+    with engine.begin() as conn:
+        for table in tables:
+            if engine.dialect.name == "mssql":
+                conn.exec_driver_sql(f"UPDATE STATISTICS {table.__tablename__}")
+            else:
+                conn.exec_driver_sql(f"ANALYZE {table.__tablename__}")
+
+
+def arrow_schema(table: Table, dictionary_columns: list[str] = ()) -> pa.Schema:
+    """
+    Return the Arrow schema for a DB table. Columns in dictionary_columns are
+    dictionary encoded strings.
+    """
+    fields = []
+    for column in table.columns:
+        if column.name in dictionary_columns:
+            arrow_type = pa.dictionary(pa.int32(), pa.string())
+        elif isinstance(column.type, types.Boolean):
+            arrow_type = pa.bool_()
+        elif isinstance(column.type, types.Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column.type, types.DateTime):
+            arrow_type = pa.timestamp("us")
+        elif isinstance(column.type, types.Date):
+            arrow_type = pa.date32()
+        elif isinstance(column.type, types.Float):
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(column.name, arrow_type, nullable=column.nullable))
+    return pa.schema(fields)
+
+
+def write_snapshot(
+    engine,
+    table: SQLModel,
+    path: str,
+    dictionary_columns: list[str] = (),
+    metadata: dict = None,
+    order_by: str = None,
+) -> None:
+    """
+    Write the contents of table to an uncompressed Arrow IPC file at path, which readers
+    can memory map. The file is replaced atomically. Rows are sorted by the order_by SQL
+    expression if given.
+    """
+    logging.info(f"Writing snapshot of {table.__tablename__} to {path}")
+    schema = arrow_schema(table.__table__, dictionary_columns)
+    read_schema = pa.schema(
+        [
+            f.with_type(f.type.value_type) if pa.types.is_dictionary(f.type) else f
+            for f in schema
+        ]
+    )
+
+    # Read in batches into Arrow memory, which is much more compact than pandas objects
+    batches = []
+    with engine.connect() as conn:
+        query = f"select {', '.join(schema.names)} from {table.__tablename__}"
+        if order_by:
+            query += f" order by {order_by}"
+        for df in pd.read_sql_query(query, conn, chunksize=SNAPSHOT_BATCH):
+            for field in read_schema:
+                if pa.types.is_date(field.type) or pa.types.is_timestamp(field.type):
+                    df[field.name] = pd.to_datetime(df[field.name])
+                elif pa.types.is_boolean(field.type):
+                    df[field.name] = df[field.name].astype("boolean")
+            batches.append(
+                pa.RecordBatch.from_pandas(df, schema=read_schema, preserve_index=False)
+            )
+
+    # Dictionary encode into a single dictionary per column
+    arrow_table = pa.Table.from_batches(batches, schema=read_schema).combine_chunks()
+    arrow_table = arrow_table.cast(schema).replace_schema_metadata(metadata)
+
+    tmp_path = path + ".tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    os.replace(tmp_path, path)
+
+
+def read_watermarks(engine, watermark_table) -> dict:
+    """
+    Return stored watermark rows keyed by source table. Values are converted back from
+    strings to int or datetime when possible.
+    """
+    with Session(engine) as session:
+        watermarks = session.exec(select(watermark_table)).all()
+
+    ret = {}
+    for wm in watermarks:
+        ret[wm.source_table] = wm
+        if wm.value is None:
+            continue
+        for parse in (int, datetime.fromisoformat):
+            try:
+                wm.value = parse(wm.value)
+                break
+            except ValueError:
+                pass
+    return ret
+
+
+def write_watermarks(
+    engine, watermark_table, watermarks: dict, full_ingest: datetime
+) -> None:
+    """
+    Replace stored watermarks. watermarks maps source table -> (column, value).
+    """
+    logging.info("Writing watermarks")
+    with Session(engine) as session:
+        session.exec(delete(watermark_table))
+        for table, (column, value) in watermarks.items():
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            elif value is not None:
+                value = str(value)
+            session.add(
+                watermark_table(
+                    source_table=table,
+                    column=column,
+                    value=value,
+                    full_ingest=full_ingest,
+                )
+            )
+        session.commit()
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process, in MB, since start or the last
+    reset_peak_rss()
+    """
+    # On Linux, ru_maxrss survives exec() and so includes the parent's RSS at fork time,
+    # and cannot be reset. VmHWM is reset with the new address space.
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 2**10
+
+
+def reset_peak_rss() -> None:
+    """
+    Reset the peak RSS high water mark to the current RSS, where supported (Linux)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _cpu_seconds() -> float:
+    # Include finished child processes, eg. transform workers
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+@contextmanager
+def measure_stage(stage: str, stats: list[StageStats]):
+    """
+    Measure wall time, CPU time and peak RSS of the enclosed block, and append the
+    results to stats. The caller may set rows_in and rows_out on the yielded StageStats.
+    If the block raises, the stage is still recorded, with error set.
+    """
+    stage_stats = StageStats(stage=stage)
+    reset_peak_rss()
+    wall_start, cpu_start = time.perf_counter(), _cpu_seconds()
+    try:
+        yield stage_stats
+    except BaseException:
+        stage_stats.error = True
+        raise
+    finally:
+        stage_stats.wall_seconds = round(time.perf_counter() - wall_start, 4)
+        stage_stats.cpu_seconds = round(_cpu_seconds() - cpu_start, 4)
+        stage_stats.peak_rss_mb = round(peak_rss_mb(), 1)
+        logging.info(
+            f"Stage {stage}{' failed' if stage_stats.error else ''}: "
+            f"{stage_stats.wall_seconds}s wall, {stage_stats.cpu_seconds}s cpu, "
+            f"rows in {stage_stats.rows_in}, rows out {stage_stats.rows_out}, "
+            f"peak RSS {stage_stats.peak_rss_mb} MB"
+        )
+        stats.append(stage_stats)
+
+
+def add_missing_columns(engine, table: SQLModel) -> None:
+    """
+    Add any columns of table's model that are missing from the existing DB table, as
+    nullable columns. For history tables that are kept across runs rather than replaced,
+    which create_all() does not update when the model gains a column.
+    """
+    table = table.__table__
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    missing = [column for column in table.columns if column.name not in existing]
+    if not missing:
+        return
+
+    with engine.begin() as conn:
+        for column in missing:
+            logging.info(f"Adding column {column.name} to {table.name}")
+            col_type = column.type.compile(dialect=engine.dialect)
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD {column.name} {col_type}"
+            )
+
+
+def write_ingest_stats(
+    engine, ingest_run_table, run_started: datetime, mode: str, stats: list[StageStats]
+) -> None:
+    """
+    Append the stage stats of an ingest run to the ingest run history table
+    """
+    with Session(engine) as session:
+        for stage_stats in stats:
+            session.add(
+                ingest_run_table(
+                    run_started=run_started, mode=mode, **asdict(stage_stats)
+                )
+            )
+        session.commit()
 
 
 def write_meta(engine, meta_table):
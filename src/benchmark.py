@@ -0,0 +1,446 @@
+"""
+Benchmarks for the app's data loading paths. Run from the repository root, eg.
+    python -m src.benchmark encrypt --size-mb 200
+    python -m src.benchmark load --db panel.sqlite3
+    python -m src.benchmark from_db --db panel.sqlite3
+    python -m src.benchmark encounters --db panel.sqlite3
+    python -m src.benchmark sessions --db panel.sqlite3 --sessions 16
+    python -m src.benchmark startup --secret PRH_PANEL_SNAPSHOT_DIR=snapshot
+Results are printed as JSON, and written to --out if given.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import sqlite3
+import subprocess
+import tracemalloc
+from datetime import datetime
+from cryptography.fernet import Fernet
+from .model import encrypt, datasources, source_data
+
+
+def measure(fn, *args, **kwargs) -> dict:
+    """
+    Run fn twice and return its wall time from the first run and peak Python heap
+    allocation from the second, since tracing slows down allocation heavy code
+    """
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": round(seconds, 4), "peak_mb": round(peak / 2**20, 1)}
+
+
+# -------------------------------------------------------
+# Benchmarks
+# -------------------------------------------------------
+def bench_encrypt(args) -> list[dict]:
+    """
+    Compare whole-file Fernet with the streaming chunked format, encrypting and
+    decrypting a file of random data
+    """
+    key = Fernet.generate_key().decode()
+    size = args.size_mb * 2**20
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        plain = os.path.join(tmpdir, "plain")
+        enc = os.path.join(tmpdir, "enc")
+        dec = os.path.join(tmpdir, "dec")
+        with open(plain, "wb") as f:
+            for _ in range(args.size_mb):
+                f.write(os.urandom(2**20))
+
+        def legacy_encrypt():
+            with open(plain, "rb") as f:
+                data = f.read()
+            with open(enc, "wb") as f:
+                f.write(Fernet(key).encrypt(data))
+
+        def legacy_decrypt():
+            with open(enc, "rb") as f:
+                data = f.read()
+            with open(dec, "wb") as f:
+                f.write(Fernet(key).decrypt(data))
+
+        for name, encrypt_fn, decrypt_fn in [
+            ("fernet", legacy_encrypt, legacy_decrypt),
+            (
+                "stream",
+                lambda: encrypt.encrypt_file(plain, enc, key),
+                lambda: encrypt.decrypt_file(enc, dec, key),
+            ),
+        ]:
+            for op, fn in [("encrypt", encrypt_fn), ("decrypt", decrypt_fn)]:
+                result = {"format": name, "op": op, "size_mb": args.size_mb}
+                result.update(measure(fn))
+                result["mb_per_sec"] = round(size / 2**20 / result["seconds"], 1)
+                results.append(result)
+
+    return results
+
+
+def bench_load(args) -> list[dict]:
+    """
+    Compare decrypting the DB to a temp file and opening it with loading it directly into
+    memory, uncompressed and zstd compressed, then reading all tables with
+    source_data.from_db()
+    """
+    key = Fernet.generate_key().decode()
+    artifacts = {}
+    for codec in ["none", "zstd"]:
+        artifacts[codec] = io.BytesIO()
+        with open(args.db, "rb") as f:
+            encrypt.encrypt_stream(
+                f, artifacts[codec], key, codec=encrypt.CODECS[codec]
+            )
+    size_mb = os.path.getsize(args.db) / 2**20
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmp_path = os.path.join(tmpdir, "tmp.sqlite3")
+
+        def load_tempfile(enc):
+            enc.seek(0)
+            with open(tmp_path, "wb") as f:
+                encrypt.decrypt_stream(enc, f, key)
+            return sqlite3.connect(tmp_path, check_same_thread=False)
+
+        def load_memory(enc):
+            enc.seek(0)
+            return datasources.load_db(enc, key)
+
+        for name, codec, load_fn in [
+            ("tempfile", "none", load_tempfile),
+            ("memory", "none", load_memory),
+            ("memory", "zstd", load_memory),
+        ]:
+            enc = artifacts[codec]
+            conns = []
+            result = {
+                "method": name,
+                "codec": codec,
+                "size_mb": round(size_mb, 1),
+                "artifact_mb": round(len(enc.getbuffer()) / 2**20, 1),
+            }
+            result["load"] = measure(lambda: conns.append(load_fn(enc)))
+            engine = datasources.engine_from_conn(conns[-1])
+            result["read"] = measure(source_data.from_db, engine)
+            engine.dispose()
+            results.append(result)
+
+    return results
+
+
+def bench_from_db(args) -> list[dict]:
+    """
+    Compare reading the DB tables with pd.read_sql_table with the typed loader in
+    source_data.from_db()
+    """
+    import pandas as pd
+
+    def read_sql_table(engine):
+        return {
+            table: pd.read_sql_table(table, engine)
+            for table in ["patients", "encounters"]
+        }
+
+    def typed_loader(engine):
+        src_data = source_data.from_db(engine)
+        return {"patients": src_data.patients_df, "encounters": src_data.encounters_df}
+
+    results = []
+    for name, read_fn in [
+        ("read_sql_table", read_sql_table),
+        ("typed_loader", typed_loader),
+    ]:
+        engine = datasources.connect_file(args.db)
+        dfs = {}
+        result = {"method": name}
+        result.update(measure(lambda: dfs.update(read_fn(engine))))
+        result["df_mb"] = {
+            table: round(df.memory_usage(deep=True).sum() / 2**20, 1)
+            for table, df in dfs.items()
+        }
+        engine.dispose()
+        results.append(result)
+
+    return results
+
+
+def bench_encounters(args) -> list[dict]:
+    """
+    Latency of looking up the selected patient's encounters, as st_encounter_table does on
+    every rerun: a copy and full scan of encounters, versus the encounter index
+    """
+    import numpy as np
+
+    engine = datasources.connect_file(args.db)
+    src_data = source_data.from_db(engine)
+    engine.dispose()
+    encounters_df = src_data.encounters_df
+    index = src_data.encounter_index
+
+    start = time.perf_counter()
+    source_data.EncounterIndex.build(encounters_df)
+    build_seconds = time.perf_counter() - start
+
+    rng = np.random.default_rng(0)
+    mrns = rng.choice(encounters_df["mrn"].dropna().unique(), args.lookups)
+
+    def scan(mrn):
+        df = encounters_df.copy()
+        return df[df["mrn"] == mrn]
+
+    results = []
+    for name, lookup_fn in [
+        ("scan", scan),
+        ("index", lambda mrn: index.lookup(encounters_df, mrn)),
+    ]:
+        latencies = []
+        for mrn in mrns:
+            start = time.perf_counter()
+            lookup_fn(mrn)
+            latencies.append(time.perf_counter() - start)
+        results.append(
+            {
+                "method": name,
+                "encounters": len(encounters_df),
+                "lookups": len(mrns),
+                "mean_ms": round(np.mean(latencies) * 1000, 4),
+                "p50_ms": round(np.percentile(latencies, 50) * 1000, 4),
+                "p99_ms": round(np.percentile(latencies, 99) * 1000, 4),
+            }
+        )
+    results[-1]["build_seconds"] = round(build_seconds, 4)
+    return results
+
+
+def bench_sessions(args) -> list[dict]:
+    """
+    Memory and latency per session with concurrent sessions rerunning the explorer, when
+    source data is cached with st.cache_data, which gives each rerun its own copy, versus
+    st.cache_resource, which shares one read-only copy, versus the pushdown backend, which
+    queries the DB. Memory is traced Python heap and Arrow allocations, for the initial
+    load and for what the sessions hold after one rerun each.
+    """
+    import threading
+    import numpy as np
+    import pyarrow as pa
+    import streamlit as st
+    from .model import data, pushdown
+
+    def load():
+        return source_data.read_file(args.db)
+
+    def load_pushdown():
+        return pushdown.PushdownData(datasources.open_file(args.db))
+
+    def traced(fn) -> tuple[object, int]:
+        # Return value of fn and the bytes it allocated and kept
+        arrow_start = pa.total_allocated_bytes()
+        tracemalloc.start()
+        value = fn()
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return value, traced + pa.total_allocated_bytes() - arrow_start
+
+    def run_sessions(get_data, reruns: int) -> tuple[list, list[float]]:
+        # Each session keeps the data from its last rerun, as the app does during a run
+        held = [None] * args.sessions
+        latencies = []
+        barrier = threading.Barrier(args.sessions)
+
+        def session(i):
+            rng = np.random.default_rng(i)
+            barrier.wait()
+            for _ in range(reruns):
+                start = time.perf_counter()
+                src_data = get_data()
+                clinic = rng.choice(["All"] + src_data.clinics)
+                app_data = data.process({"clinic": clinic}, src_data)
+                patients_df = app_data.paneled_patients_df
+                mrn = patients_df["mrn"].iloc[rng.integers(len(patients_df))]
+                src_data.patient_encounters(mrn)
+                latencies.append(time.perf_counter() - start)
+                held[i] = src_data
+
+        threads = [
+            threading.Thread(target=session, args=(i,)) for i in range(args.sessions)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return held, latencies
+
+    results = []
+    for name, cache, load_fn in [
+        ("cache_data", st.cache_data, load),
+        ("cache_resource", st.cache_resource, load),
+        ("pushdown", st.cache_resource, load_pushdown),
+    ]:
+        # AppData is memoized by data version, which is the same for all methods
+        data._process.clear()
+        get_data = cache(load_fn)
+        _, load_bytes = traced(get_data)
+
+        _, latencies = run_sessions(get_data, args.reruns)
+        _, session_bytes = traced(lambda: run_sessions(get_data, 1)[0])
+
+        results.append(
+            {
+                "method": name,
+                "sessions": args.sessions,
+                "reruns": len(latencies),
+                "mean_ms": round(np.mean(latencies) * 1000, 2),
+                "p50_ms": round(np.percentile(latencies, 50) * 1000, 2),
+                "p99_ms": round(np.percentile(latencies, 99) * 1000, 2),
+                "load_mb": round(load_bytes / 2**20, 2),
+                "mb_per_session": round(session_bytes / args.sessions / 2**20, 2),
+            }
+        )
+        get_data.clear()
+    return results
+
+
+# Modules imported by app.py, profiled by the startup benchmark
+APP_IMPORTS = "import src.model.source_data, src.model.datasources, src.ui.explorer"
+
+# Run in a fresh interpreter to time the first render of app.py with AppTest
+FIRST_RENDER = """
+import sys, json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=600)
+at.secrets.update(json.loads(sys.argv[2]))
+ready = time.perf_counter()
+at.run()
+print(json.dumps({
+    "harness_seconds": round(ready - start, 4),
+    "first_render_seconds": round(time.perf_counter() - ready, 4),
+    "exceptions": [e.value for e in at.exception],
+}))
+"""
+
+
+def bench_startup(args) -> dict:
+    """
+    Profile app startup in fresh interpreters: import time of each top level package
+    imported by the app, and time for the first run of app.py to render
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": root}
+
+    # -X importtime lines are "import time: <self us> | <cumulative us> | <name>". Sum
+    # self time by top level package.
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", APP_IMPORTS],
+        cwd=root,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = {}
+    for line in proc.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        package = fields[2].strip().split(".")[0]
+        imports[package] = imports.get(package, 0) + int(fields[0]) / 1e6
+    imports = {
+        package: round(seconds, 4)
+        for package, seconds in sorted(imports.items(), key=lambda item: -item[1])
+        if seconds >= 0.001
+    }
+
+    secrets = dict(secret.split("=", 1) for secret in args.secret)
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            FIRST_RENDER,
+            os.path.join(root, "app.py"),
+            json.dumps(secrets),
+        ],
+        cwd=root,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    render = json.loads(proc.stdout.splitlines()[-1])
+    render["process_seconds"] = round(time.perf_counter() - start, 4)
+
+    return {
+        "import_seconds": round(sum(imports.values()), 4),
+        "imports": imports,
+        "render": render,
+    }
+
+
+BENCHMARKS = {
+    "encrypt": bench_encrypt,
+    "load": bench_load,
+    "from_db": bench_from_db,
+    "encounters": bench_encounters,
+    "sessions": bench_sessions,
+    "startup": bench_startup,
+}
+
+
+# -------------------------------------------------------
+# Main entry point
+# -------------------------------------------------------
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark app data loading.")
+    parser.add_argument("benchmark", choices=BENCHMARKS.keys())
+    parser.add_argument(
+        "--size-mb", help="Size of test data in MB", type=int, default=100
+    )
+    parser.add_argument(
+        "--db", help="SQLite DB to load", default=datasources.LOCAL_DB_PATH
+    )
+    parser.add_argument("--lookups", help="Patients to look up", type=int, default=200)
+    parser.add_argument(
+        "--sessions", help="Concurrent app sessions", type=int, default=8
+    )
+    parser.add_argument("--reruns", help="Reruns per app session", type=int, default=20)
+    parser.add_argument(
+        "--secret",
+        help="Streamlit secret for the startup benchmark as KEY=VALUE",
+        action="append",
+        default=[],
+    )
+    parser.add_argument("-o", "--out", help="Output JSON file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    results = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "benchmark": args.benchmark,
+        "results": BENCHMARKS[args.benchmark](args),
+    }
+    print(json.dumps(results, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,16 @@ Transform source data into department specific data that can be displayed on das
 
 import pandas as pd
 import math
+import streamlit as st
 from dataclasses import dataclass
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from . import source_data
 
+# Number of (clinic, data version) pairs to keep processed AppData for. Shared by all
+# sessions, so switching clinics or rerunning for any other widget reuses the result.
+APP_DATA_MAX_ENTRIES = 32
+
 
 @dataclass(frozen=True)
 class AppData:
@@ -18,8 +23,8 @@ class AppData:
     # Patients assigned to this clinic's panel
     paneled_patients_df: pd.DataFrame
 
-    # All encounters
-    encounters_df: pd.DataFrame
+    # Counts of paneled patients by sex, age_group and location
+    demographics: pd.DataFrame
 
 
 def process(settings: dict, src: source_data.SourceData) -> AppData:
@@ -27,19 +32,21 @@ def process(settings: dict, src: source_data.SourceData) -> AppData:
     Receives raw source data from database.
     Partitions and computes statistics to be displayed by the app.
     settings contains any configuration from the sidebar that the user selects.
+    src may also be a pushdown.PushdownData, which answers the same queries.
     """
-    clinic = settings["clinic"]
+    return _process(settings["clinic"], src.version, src)
+
 
+@st.cache_resource(max_entries=APP_DATA_MAX_ENTRIES, show_spinner=False)
+def _process(clinic: str, version: str, _src: source_data.SourceData) -> AppData:
+    """
+    Memoized by clinic and data version. _src is not hashed, as version identifies it.
+    """
     # Filter patients by clinic
-    if (clinic == "All") or (clinic is None):
-        paneled_patients_df = src.patients_df
-    else:
-        paneled_patients_df = src.patients_df[
-            src.patients_df["panel_location"] == clinic
-        ]
+    query_clinic = None if clinic == "All" else clinic
 
     return AppData(
         clinic=clinic,
-        paneled_patients_df=paneled_patients_df,
-        encounters_df=src.encounters_df,
+        paneled_patients_df=_src.clinic_patients(query_clinic),
+        demographics=_src.clinic_demographics(query_clinic),
     )
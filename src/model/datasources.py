@@ -1,11 +1,11 @@
-import os, io, logging
+import os, io, logging, time
 import sqlite3
-import boto3
+import tempfile
 import streamlit as st
-from . import encrypt
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
-import pandas as pd
-from sqlalchemy import create_engine
+from concurrent.futures import ThreadPoolExecutor
+
+# boto3, sqlalchemy and cryptography (via encrypt) are imported where used, since they are
+# slow to import and not needed on every startup path
 
 # Path to default app database: panel.sqlite3 next to ingest.py
 DB_FILE = "panel.sqlite3"
@@ -13,6 +13,10 @@ LOCAL_DB_PATH = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), "..", "..", DB_FILE
 )
 
+# Optional directory with an Arrow snapshot of the DB tables written by ingest --snapshot.
+# If set, the app loads it instead of the remote DB.
+SNAPSHOT_DIR = st.secrets.get("PRH_PANEL_SNAPSHOT_DIR")
+
 # Remote URL in Cloudflare R2
 R2_ACCT_ID = st.secrets.get("PRH_PANEL_R2_ACCT_ID")
 R2_ACCT_KEY = st.secrets.get("PRH_PANEL_R2_ACCT_KEY")
@@ -20,9 +24,42 @@ R2_URL = st.secrets.get("PRH_PANEL_R2_URL")
 R2_BUCKET = st.secrets.get("PRH_PANEL_R2_BUCKET")
 R2_OBJECT = DB_FILE + ".enc"
 
+# Optional key of the manifest of a DB published as per-table partitions (see
+# partitions.py). If set, the app loads the partitions instead of R2_OBJECT.
+R2_MANIFEST = st.secrets.get("PRH_PANEL_R2_MANIFEST")
+MANIFEST_FILE = "manifest.json"
+
+# If set, the remote object is polled for changes every this many seconds and reloaded in
+# the background instead of on a cache miss in a user request
+REFRESH_SECONDS = st.secrets.get("PRH_PANEL_REFRESH_SECONDS")
+
+# Local cache of downloaded remote objects, kept encrypted and keyed by ETag so an unchanged
+# object is not downloaded again. Least recently used versions are evicted past the limit.
+CACHE_DIR = st.secrets.get(
+    "PRH_PANEL_CACHE_DIR", os.path.join(tempfile.gettempdir(), "prh-panel-cache")
+)
+CACHE_MAX_MB = st.secrets.get("PRH_PANEL_CACHE_MAX_MB", 1024)
+
+# Remote objects larger than one range are downloaded as concurrent ranged GETs
+DOWNLOAD_RANGE_MB = st.secrets.get("PRH_PANEL_DOWNLOAD_RANGE_MB", 8)
+DOWNLOAD_WORKERS = st.secrets.get("PRH_PANEL_DOWNLOAD_WORKERS", 8)
+DOWNLOAD_RETRIES = 3
+
+# "memory" loads all DB tables into dataframes (see source_data.py). "pushdown" keeps the
+# DB open on disk and queries it as the app needs, for data too large to hold in memory
+# (see pushdown.py). Query results are kept in an LRU cache of this many entries.
+BACKEND = st.secrets.get("PRH_PANEL_BACKEND", "memory")
+QUERY_CACHE_ENTRIES = st.secrets.get("PRH_PANEL_QUERY_CACHE_ENTRIES", 256)
+
 # Encryption key for remote database
 DATA_KEY = st.secrets.get("PRH_PANEL_DATA_KEY")
 
+# Read size when streaming downloads
+CHUNK_SIZE = 1024 * 1024
+
+# Memory backed directory for the DB file when sqlite3 cannot deserialize a buffer
+SHM_DIR = "/dev/shm"
+
 
 def connect_file(file=LOCAL_DB_PATH):
     """
@@ -40,37 +77,29 @@ def connect_s3(
     bucket=R2_BUCKET,
     obj=R2_OBJECT,
     data_key=DATA_KEY,
+    cache_dir=CACHE_DIR,
 ):
     """
     Fetches the SQLite database file from a remote S3-compatible storage, decrypts it,
-    and loads it into an in-memory SQLite database.
+    and loads it into an in-memory SQLite database. If cache_dir is set, the file is only
+    downloaded when it differs from the copy cached there.
     Returns a SQLAlchemy engine to the SQLite database in memory.
     """
+    from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+
     try:
-        # Initialize the S3 client
         logging.info("Fetch remote DB file")
-        s3_client = boto3.client(
-            "s3",
-            endpoint_url=url,
-            region_name="auto",
-            aws_access_key_id=acct_id,
-            aws_secret_access_key=acct_key,
-        )
+        s3_client = get_s3_client(acct_id, acct_key, url)
 
-        # Fetch the encrypted database file from the remote storage
-        response = s3_client.get_object(Bucket=bucket, Key=obj)
-        remote_db = response["Body"].read()
-
-        # Decrypt the database file
-        logging.info("Decrypting")
-        decrypted_db = (
-            encrypt.decrypt(remote_db, data_key) if DATA_KEY is not None else remote_db
-        )
-
-        # Write the decrypted database to an in-memory SQLite database
-        logging.info("Reading DB to memory")
-        open("tmp.sqlite3", "wb").write(decrypted_db)
-        conn = sqlite3.connect("tmp.sqlite3")
+        if cache_dir:
+            path = fetch_cached(s3_client, bucket, obj, cache_dir)
+            logging.info("Decrypting DB to memory")
+            with open(path, "rb") as f:
+                conn = load_db(f, data_key)
+        else:
+            _, data = download(s3_client, bucket, obj)
+            logging.info("Decrypting DB to memory")
+            conn = load_db(io.BytesIO(data), data_key)
         return engine_from_conn(conn)
 
     except (NoCredentialsError, PartialCredentialsError) as e:
@@ -81,9 +110,282 @@ def connect_s3(
         raise
 
 
+def connect_s3_file(
+    acct_id=R2_ACCT_ID,
+    acct_key=R2_ACCT_KEY,
+    url=R2_URL,
+    bucket=R2_BUCKET,
+    obj=R2_OBJECT,
+    data_key=DATA_KEY,
+    cache_dir=CACHE_DIR,
+) -> sqlite3.Connection:
+    """
+    Fetches the remote database file through the cache in cache_dir, and returns a
+    read-only connection to a decrypted copy that stays on disk instead of in memory. The
+    copy is a private file of this process in the system temp directory (see
+    connect_private_file()), so the cache only ever holds encrypted data. It is not put
+    in SHM_DIR, which is memory backed and often small in containers.
+    """
+    from . import encrypt
+
+    s3_client = get_s3_client(acct_id, acct_key, url)
+    path = fetch_cached(s3_client, bucket, obj, cache_dir)
+    logging.info("Decrypting DB to private file")
+    with open(path, "rb") as fin:
+        return connect_private_file(
+            lambda fout: encrypt.decrypt_stream(fin, fout, data_key)
+        )
+
+
+def open_file(file=LOCAL_DB_PATH) -> sqlite3.Connection:
+    """
+    Returns a read-only connection to the SQLite database file, which stays on disk
+    """
+    return sqlite3.connect(f"file:{file}?mode=ro", uri=True, check_same_thread=False)
+
+
+def get_s3_client(acct_id=R2_ACCT_ID, acct_key=R2_ACCT_KEY, url=R2_URL):
+    """
+    Returns a boto3 client for the remote S3-compatible storage
+    """
+    import boto3
+
+    return boto3.client(
+        "s3",
+        endpoint_url=url,
+        region_name="auto",
+        aws_access_key_id=acct_id,
+        aws_secret_access_key=acct_key,
+    )
+
+
+def remote_version(obj=R2_OBJECT, bucket=R2_BUCKET):
+    """
+    Returns the ETag of the remote object, which changes whenever it is republished
+    """
+    return get_s3_client().head_object(Bucket=bucket, Key=obj)["ETag"]
+
+
+def fetch_cached(s3_client, bucket, obj, cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB):
+    """
+    Returns the path to a local copy of obj in cache_dir. The object is requested with
+    If-None-Match set to the ETag of the newest cached copy, so it is only transferred
+    if it changed remotely.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix = obj.replace("/", "_") + "."
+    cached = [
+        entry
+        for entry in os.scandir(cache_dir)
+        if entry.name.startswith(prefix) and not entry.name.endswith(".part")
+    ]
+    cached.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+
+    # File names hold the ETag without its quotes, which are part of the header value
+    etag = f'"{cached[0].name[len(prefix) :]}"' if cached else None
+    result = download(s3_client, bucket, obj, if_none_match=etag)
+    if result is None:
+        logging.info("Remote DB unchanged, using cached copy")
+        os.utime(cached[0].path)
+        return cached[0].path
+
+    etag, data = result
+    path = os.path.join(cache_dir, prefix + etag.strip('"'))
+    write_cache(path, data, max_mb)
+    return path
+
+
+def write_cache(path, data, max_mb=CACHE_MAX_MB, keep=()):
+    """
+    Writes data to path in the cache directory, then evicts old entries other than path
+    and the paths in keep. Writes go to a private temp file that is renamed into place, so
+    concurrent fetches never see a partial file.
+    """
+    cache_dir = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    evict_cache(cache_dir, max_mb, keep={path, *keep})
+
+
+def download(
+    s3_client,
+    bucket,
+    obj,
+    if_none_match=None,
+    range_mb=DOWNLOAD_RANGE_MB,
+    workers=DOWNLOAD_WORKERS,
+):
+    """
+    Downloads obj and returns (etag, data), or None if its ETag matches if_none_match.
+    The first range is fetched with a single GET, which is the whole object if it is small.
+    The total size comes back in that response, and the remaining ranges are fetched
+    concurrently into a preallocated buffer, each retried on its own.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    range_size = int(range_mb * 2**20)
+    kwargs = {"IfNoneMatch": if_none_match} if if_none_match else {}
+    try:
+        response = s3_client.get_object(
+            Bucket=bucket, Key=obj, Range=f"bytes=0-{range_size - 1}", **kwargs
+        )
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if if_none_match and code in ("304", "NotModified"):
+            return None
+        if code != "InvalidRange":
+            raise
+        # Empty objects cannot be requested by range
+        response = s3_client.get_object(Bucket=bucket, Key=obj, **kwargs)
+
+    # ContentRange is "bytes <start>-<end>/<total>"; absent if the whole object was returned
+    etag = response["ETag"]
+    content_range = response.get("ContentRange")
+    total = int(content_range.split("/")[-1]) if content_range else None
+    if total is None or total <= range_size:
+        return etag, response["Body"].read()
+
+    data = bytearray(total)
+    view = memoryview(data)
+    ranges = [
+        (start, min(start + range_size, total)) for start in range(0, total, range_size)
+    ]
+    try:
+        _read_range(response["Body"], view, *ranges[0])
+        ranges = ranges[1:]
+    except (BotoCoreError, OSError) as e:
+        # Fetched again with the other ranges, with retries
+        logging.warning(f"Retrying range 0-{range_size - 1}: {e}")
+
+    logging.info(f"Downloading {total} bytes in {range_size} byte ranges")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(_get_range, s3_client, bucket, obj, etag, view, start, end)
+            for start, end in ranges
+        ]
+        for future in futures:
+            future.result()
+    return etag, data
+
+
+def _get_range(s3_client, bucket, obj, etag, view, start, end):
+    """
+    Fetches bytes [start, end) of obj into view[start:end], retrying on network errors.
+    If-Match ensures every range comes from the same version of the object.
+    """
+    from botocore.exceptions import BotoCoreError
+
+    for attempt in range(DOWNLOAD_RETRIES):
+        try:
+            response = s3_client.get_object(
+                Bucket=bucket, Key=obj, Range=f"bytes={start}-{end - 1}", IfMatch=etag
+            )
+            _read_range(response["Body"], view, start, end)
+            return
+        except (BotoCoreError, OSError) as e:
+            if attempt == DOWNLOAD_RETRIES - 1:
+                raise
+            logging.warning(f"Retrying range {start}-{end - 1}: {e}")
+            time.sleep(2**attempt)
+
+
+def _read_range(body, view, start, end):
+    pos = start
+    for chunk in body.iter_chunks(CHUNK_SIZE):
+        view[pos : pos + len(chunk)] = chunk
+        pos += len(chunk)
+    if pos != end:
+        raise IOError(f"Expected {end - start} bytes, received {pos - start}")
+
+
+def evict_cache(cache_dir=CACHE_DIR, max_mb=CACHE_MAX_MB, keep=()):
+    """
+    Removes least recently used files from cache_dir until it is under max_mb, never
+    removing the paths in keep
+    """
+    entries = [
+        entry
+        for entry in os.scandir(cache_dir)
+        if entry.is_file() and not entry.name.endswith(".part")
+    ]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    total = sum(entry.stat().st_size for entry in entries)
+    for entry in entries:
+        if total <= max_mb * 2**20:
+            break
+        if entry.path not in keep:
+            logging.info(f"Evicting {entry.name} from cache")
+            total -= entry.stat().st_size
+            os.remove(entry.path)
+
+
+def load_db(fin, data_key=None) -> sqlite3.Connection:
+    """
+    Reads a SQLite database file from the file-like object fin, decrypting and decompressing
+    it with data_key if given, and returns a read-only connection to an in-memory copy of it.
+    """
+    from . import encrypt
+
+    buf = io.BytesIO()
+    if data_key is not None:
+        encrypt.decrypt_stream(fin, buf, data_key)
+    else:
+        while chunk := fin.read(CHUNK_SIZE):
+            buf.write(chunk)
+
+    with buf.getbuffer() as data:
+        return connect_buffer(data)
+
+
+def connect_buffer(data) -> sqlite3.Connection:
+    """
+    Returns a read-only connection to the SQLite database image in data. The image is handed
+    directly to SQLite when supported (Python 3.11+). Otherwise it is written to a private
+    file on a memory backed filesystem, which is unlinked once opened.
+    """
+    if hasattr(sqlite3.Connection, "deserialize"):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        conn.deserialize(data)
+        conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    return connect_private_file(
+        lambda f: f.write(data), SHM_DIR if os.path.isdir(SHM_DIR) else None
+    )
+
+
+def connect_private_file(write, dir=None) -> sqlite3.Connection:
+    """
+    Calls write(f) to write a SQLite database file to a private file in dir, or the system
+    temp directory, and returns a read-only connection to it. The file is unlinked once
+    opened, so no other process can read it and it is freed when the connection is closed.
+    """
+    fd, path = tempfile.mkstemp(suffix=".sqlite3", dir=dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        conn = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        # Force SQLite to open the file before it is removed
+        conn.execute("PRAGMA schema_version")
+    finally:
+        os.remove(path)
+    return conn
+
+
 def engine_from_conn(conn):
     """
     Returns a SQLAlchemy engine object from a sqlite3 connection object.
     Returns sqlalchemy.engine.base.Connection as a connection object from the given the SQLite database connection
     """
+    from sqlalchemy import create_engine
+
     return create_engine(f"sqlite://", creator=lambda: conn)
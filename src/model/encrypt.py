@@ -1,48 +1,209 @@
 """
-Symmetric encryption and decryption using Fernet.
+Symmetric encryption and decryption.
+Data is encrypted in a streaming format of AES-GCM authenticated chunks, so files can be
+processed in constant memory. Data in the legacy Fernet format can still be decrypted.
 Run this file directly to print out a new randomly generated key.
 """
 
 import sys, os
+import io
+import base64
+import struct
 import logging
-import requests
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-def encrypt(data: bytes, key: str) -> bytes:
-    fernet = Fernet(key)
-    encrypted = fernet.encrypt(data)
-    return encrypted
+# Streaming format:
+#   header: MAGIC, version (1 byte), [codec (1 byte), version 2+], chunk size (4 bytes),
+#           nonce prefix (8 bytes)
+#   chunks: AES-GCM ciphertext + 16 byte tag of each chunk_size bytes of plaintext. The
+#           last chunk is shorter than chunk_size (possibly empty), so truncation at a chunk
+#           boundary is detected. Each chunk's nonce is the prefix + chunk counter, and its
+#           associated data is the header + a last-chunk flag, so chunks cannot be
+#           reordered, dropped or moved between files.
+# The plaintext is compressed with codec before it is encrypted. Version 1 files have no
+# codec byte and are uncompressed.
+MAGIC = b"PRHENC"
+VERSION = 2
+HEADERS = {
+    1: struct.Struct(">6sBI8s"),
+    2: struct.Struct(">6sBBI8s"),
+}
+TAG_SIZE = 16
+DEFAULT_CHUNK_SIZE = 1024 * 1024
 
+# Compression codecs
+CODEC_NONE = 0
+CODEC_ZSTD = 1
+CODECS = {"none": CODEC_NONE, "zstd": CODEC_ZSTD}
+ZSTD_LEVEL = 9
 
-def encrypt_file(file: str, outfile: str, key: str):
-    with open(file, "rb") as f:
-        data = f.read()
-    encrypted = encrypt(data, key)
-    with open(f"{outfile}", "wb") as f:
-        f.write(encrypted)
+
+def _derive(key: str, info: bytes, length: int = 32) -> bytes:
+    """
+    Derive length bytes for the purpose named by info from a Fernet key
+    """
+    key_bytes = base64.urlsafe_b64decode(key)
+    if len(key_bytes) != 32:
+        raise ValueError("Key must be 32 url-safe base64-encoded bytes")
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=length,
+        salt=None,
+        info=info,
+    ).derive(key_bytes)
+
+
+def _stream_key(key: str) -> AESGCM:
+    """
+    Derive the AES-256-GCM key for the streaming format from a Fernet key
+    """
+    return AESGCM(_derive(key, b"prh-panel stream v1"))
+
+
+def key_id(key: str) -> str:
+    """
+    Return a short public fingerprint of key, to tell which key data was encrypted with
+    without revealing the key
+    """
+    return _derive(key, b"prh-panel key id v1", 8).hex()
+
+
+def _zstandard():
+    """
+    Return the zstandard module, which is only required for compressed files
+    """
+    if zstandard is None:
+        raise ImportError("zstandard is required for zstd compressed files")
+    return zstandard
+
+
+def _read_full(f, size: int) -> bytes:
+    """
+    Read size bytes from f, or fewer only at EOF. Network streams may return short reads.
+    """
+    buf = bytearray()
+    while len(buf) < size:
+        data = f.read(size - len(buf))
+        if not data:
+            break
+        buf += data
+    return bytes(buf)
+
+
+def _nonce(prefix: bytes, counter: int) -> bytes:
+    return prefix + struct.pack(">I", counter)
+
+
+def encrypt_stream(
+    fin, fout, key: str, chunk_size: int = DEFAULT_CHUNK_SIZE, codec: int = CODEC_NONE
+):
+    """
+    Compress with codec and encrypt file-like fin into file-like fout in the streaming
+    format
+    """
+    aesgcm = _stream_key(key)
+    header = HEADERS[VERSION].pack(MAGIC, VERSION, codec, chunk_size, os.urandom(8))
+    prefix = header[-8:]
+    fout.write(header)
+
+    if codec == CODEC_ZSTD:
+        cctx = _zstandard().ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        fin = cctx.stream_reader(fin)
+    elif codec != CODEC_NONE:
+        raise ValueError(f"Unsupported codec: {codec}")
+
+    counter = 0
+    while True:
+        chunk = _read_full(fin, chunk_size)
+        last = len(chunk) < chunk_size
+        aad = header + (b"\x01" if last else b"\x00")
+        fout.write(aesgcm.encrypt(_nonce(prefix, counter), chunk, aad))
+        counter += 1
+        if last:
+            break
+
+
+def decrypt_stream(fin, fout, key: str):
+    """
+    Decrypt and decompress file-like fin into file-like fout. Data in the legacy Fernet
+    format is detected and decrypted in memory.
+    """
+    header = _read_full(fin, len(MAGIC) + 1)
+    if not header.startswith(MAGIC):
+        # Legacy whole-file Fernet token
+        fout.write(Fernet(key).decrypt(header + fin.read()))
+        return
+
+    version = header[-1]
+    if version not in HEADERS:
+        raise ValueError(f"Unsupported encryption format version: {version}")
+    header += _read_full(fin, HEADERS[version].size - len(header))
+    if version == 1:
+        _, _, chunk_size, prefix = HEADERS[version].unpack(header)
+        codec = CODEC_NONE
+    else:
+        _, _, codec, chunk_size, prefix = HEADERS[version].unpack(header)
+
+    if codec == CODEC_ZSTD:
+        dctx = _zstandard().ZstdDecompressor()
+        with dctx.stream_writer(fout, closefd=False) as writer:
+            _decrypt_chunks(fin, writer, _stream_key(key), header, chunk_size, prefix)
+    elif codec == CODEC_NONE:
+        _decrypt_chunks(fin, fout, _stream_key(key), header, chunk_size, prefix)
+    else:
+        raise ValueError(f"Unsupported codec: {codec}")
+
+
+def _decrypt_chunks(fin, fout, aesgcm, header, chunk_size, prefix):
+    counter = 0
+    while True:
+        block = _read_full(fin, chunk_size + TAG_SIZE)
+        last = len(block) < chunk_size + TAG_SIZE
+        aad = header + (b"\x01" if last else b"\x00")
+        # Raises cryptography.exceptions.InvalidTag if tampered, reordered or truncated
+        fout.write(aesgcm.decrypt(_nonce(prefix, counter), block, aad))
+        counter += 1
+        if last:
+            break
+
+
+def encrypt(data: bytes, key: str, codec: int = CODEC_NONE) -> bytes:
+    fout = io.BytesIO()
+    encrypt_stream(io.BytesIO(data), fout, key, codec=codec)
+    return fout.getvalue()
+
+
+def encrypt_file(file: str, outfile: str, key: str, codec: int = CODEC_NONE):
+    with open(file, "rb") as fin, open(outfile, "wb") as fout:
+        encrypt_stream(fin, fout, key, codec=codec)
 
 
 def decrypt(data: bytes, key: str) -> bytes:
-    fernet = Fernet(key)
-    decrypted = fernet.decrypt(data)
-    return decrypted
+    fout = io.BytesIO()
+    decrypt_stream(io.BytesIO(data), fout, key)
+    return fout.getvalue()
 
 
 def decrypt_file(file: str, outfile: str, key: str):
-    with open(file, "rb") as f:
-        data = f.read()
-    decrypted = decrypt(data, key)
-    with open(f"{outfile}.dec", "wb") as f:
-        f.write(decrypted)
+    with open(file, "rb") as fin, open(outfile, "wb") as fout:
+        decrypt_stream(fin, fout, key)
 
 
 # Run as script. With no parameters, will generate a new key. Use -key to specify key to use,
 # and -encrypt <file> or -decrypt <file> to encrypt / decrypt a file to disk
+# Use -zstd with -encrypt to compress the file before encrypting it
 # Use -out <file> to specify output filename, otherwise will default to <file>.enc or <file>.dec
 if __name__ == "__main__":
     if "-help" in sys.argv or "--help" in sys.argv:
-        print('Accepted parameters: -key, -encrypt <file>, -decrypt <file>, -out <file>.\nIf -out is not specified, will default to <file>.enc or <file>.dec')
+        print('Accepted parameters: -key, -encrypt <file>, -decrypt <file>, -out <file>, -zstd.\nIf -out is not specified, will default to <file>.enc or <file>.dec')
         exit(0)
 
     # Accept the -key parameter, or generate a new key
@@ -64,7 +225,8 @@ if __name__ == "__main__":
         file = sys.argv[sys.argv.index("-encrypt") + 1]
         if os.path.exists(file):
             out = out if out is not None else file + ".enc"
-            encrypt_file(file, out, key)
+            codec = CODEC_ZSTD if "-zstd" in sys.argv else CODEC_NONE
+            encrypt_file(file, out, key, codec)
             print(f"Encrypted {file} -> {out}")
 
     # if -decrypt <file> parameter, decrypt the specified file
@@ -0,0 +1,246 @@
+"""
+Publish and fetch the panel DB as per-table partition artifacts. Each partition is an
+Arrow IPC file, compressed and encrypted (see encrypt.py), and stored under a name that
+contains the hash of its contents and the key and codec it is encrypted with. A manifest lists the current partitions with their
+hashes, so a reader only fetches partitions that changed since its last load.
+
+Run this file to publish a DB file:
+    python -m src.model.partitions -key <key> -publish panel.sqlite3 -out <dir> [-zstd] [-upload]
+"""
+
+import os
+import sys
+import json
+import logging
+import hashlib
+import posixpath
+import pandas as pd
+import pyarrow as pa
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from . import encrypt, datasources
+
+MANIFEST_VERSION = 1
+
+# Tables to publish, with their sort key so output is stable across runs
+TABLES = {
+    "patients": "prw_id",
+    "encounters": "id",
+}
+
+# Tables split into one partition per year of a date column. Publishing a new ingest
+# then usually changes only the partition for the current year.
+PARTITION_BY_YEAR = {
+    "encounters": "encounter_date",
+}
+
+
+# -------------------------------------------------------
+# Publish
+# -------------------------------------------------------
+def split_tables(db_path: str) -> tuple[dict[str, tuple[str, pa.Table]], datetime]:
+    """
+    Read the DB at db_path and return {partition name: (table name, Arrow table)}, and the
+    DB modified time from the meta table
+    """
+    engine = create_engine(f"sqlite:///{db_path}")
+    with engine.connect() as conn:
+        modified = conn.execute(text("select max(modified) from meta")).scalar()
+
+    parts = {}
+    for table, sort_key in TABLES.items():
+        df = pd.read_sql_table(table, engine)
+        df = df.sort_values(sort_key, kind="stable", ignore_index=True)
+        if table in PARTITION_BY_YEAR:
+            year = pd.to_datetime(df[PARTITION_BY_YEAR[table]]).dt.year.astype("Int64")
+            for year_value, part_df in df.groupby(year, dropna=False):
+                suffix = "unknown" if pd.isna(year_value) else str(year_value)
+                parts[f"{table}-{suffix}"] = (
+                    table,
+                    pa.Table.from_pandas(part_df, preserve_index=False),
+                )
+        else:
+            parts[table] = (table, pa.Table.from_pandas(df, preserve_index=False))
+
+    engine.dispose()
+    return parts, modified
+
+
+def serialize(table: pa.Table) -> bytes:
+    """
+    Return table as uncompressed Arrow IPC file bytes
+    """
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def codec_name(codec: int) -> str:
+    return {value: name for name, value in encrypt.CODECS.items()}[codec]
+
+
+def object_name(name: str, sha256: str, key: str, codec: int) -> str:
+    """
+    Return the object name of a partition. The name contains the hash of the contents, and
+    the id of the key and the codec they are encrypted with. A new key or codec then
+    publishes new objects instead of reusing ones readers cannot decrypt, and cached
+    copies of old objects are never used in their place.
+    """
+    return f"{name}.{sha256[:16]}.{encrypt.key_id(key)}.{codec_name(codec)}.arrow.enc"
+
+
+def publish(
+    db_path: str, out_dir: str, key: str, codec: int = encrypt.CODEC_NONE
+) -> dict:
+    """
+    Write the partitions of the DB at db_path to out_dir as encrypted artifacts, and a
+    manifest.json describing them. Returns the manifest.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    parts, modified = split_tables(db_path)
+
+    partitions = []
+    for name, (table, arrow_table) in parts.items():
+        data = serialize(arrow_table)
+        sha256 = hashlib.sha256(data).hexdigest()
+        obj = object_name(name, sha256, key, codec)
+        path = os.path.join(out_dir, obj)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(encrypt.encrypt(data, key, codec))
+        partitions.append(
+            {
+                "name": name,
+                "table": table,
+                "object": obj,
+                "sha256": sha256,
+                "key_id": encrypt.key_id(key),
+                "codec": codec_name(codec),
+                "rows": arrow_table.num_rows,
+                "bytes": os.path.getsize(path),
+            }
+        )
+        logging.info(f"Partition {name}: {arrow_table.num_rows} rows, {sha256[:16]}")
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "modified": str(modified) if modified is not None else None,
+        "partitions": partitions,
+    }
+    with open(os.path.join(out_dir, datasources.MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def upload(out_dir: str, s3_client, bucket: str, manifest_key: str):
+    """
+    Upload the artifacts in out_dir that are not already in the bucket, then the manifest
+    to manifest_key. Partition objects go next to the manifest. The manifest is written
+    last, so readers never see it refer to missing partitions.
+    """
+    with open(os.path.join(out_dir, datasources.MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+
+    prefix = posixpath.dirname(manifest_key)
+    existing = set()
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        existing.update(item["Key"] for item in page.get("Contents", []))
+
+    for part in manifest["partitions"]:
+        obj = posixpath.join(prefix, part["object"])
+        if obj not in existing:
+            logging.info(f"Uploading {obj}")
+            s3_client.upload_file(os.path.join(out_dir, part["object"]), bucket, obj)
+
+    s3_client.upload_file(
+        os.path.join(out_dir, datasources.MANIFEST_FILE), bucket, manifest_key
+    )
+
+
+# -------------------------------------------------------
+# Fetch
+# -------------------------------------------------------
+def fetch_manifest(s3_client, bucket: str, manifest_key: str) -> dict:
+    _, data = datasources.download(s3_client, bucket, manifest_key)
+    manifest = json.loads(data)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported manifest version: {manifest.get('version')}")
+    return manifest
+
+
+def cache_path(manifest_key: str, part: dict, cache_dir: str) -> str:
+    """
+    Return the path of the cached copy of a manifest partition entry in cache_dir
+    """
+    obj = posixpath.join(posixpath.dirname(manifest_key), part["object"])
+    return os.path.join(cache_dir, obj.replace("/", "_"))
+
+
+def fetch_partition(
+    s3_client,
+    bucket: str,
+    manifest_key: str,
+    part: dict,
+    data_key: str,
+    cache_dir: str = datasources.CACHE_DIR,
+    keep=(),
+) -> pa.Table:
+    """
+    Return the Arrow table for a manifest partition entry. Artifacts are immutable, since
+    their names contain their hash, key and codec (see object_name()), so a cached copy
+    is used without checking the remote. Cached files in keep, eg. the other partitions of
+    the same manifest, are not evicted to make room for this one.
+    """
+    if "key_id" in part and part["key_id"] != encrypt.key_id(data_key):
+        raise ValueError(
+            f"Partition {part['name']} is encrypted with key {part['key_id']}, "
+            f"not the configured key {encrypt.key_id(data_key)}"
+        )
+
+    obj = posixpath.join(posixpath.dirname(manifest_key), part["object"])
+    path = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        path = cache_path(manifest_key, part, cache_dir)
+    if path and os.path.exists(path):
+        os.utime(path)
+        with open(path, "rb") as f:
+            enc = f.read()
+    else:
+        _, enc = datasources.download(s3_client, bucket, obj)
+        if path:
+            datasources.write_cache(path, enc, keep=keep)
+
+    data = encrypt.decrypt(bytes(enc), data_key)
+    if hashlib.sha256(data).hexdigest() != part["sha256"]:
+        raise ValueError(f"Hash mismatch for partition {part['name']}")
+    return pa.ipc.open_file(pa.py_buffer(data)).read_all()
+
+
+# Run as script. See module docstring for parameters. -upload uses the R2 settings from
+# streamlit secrets and uploads to PRH_PANEL_R2_MANIFEST.
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if "-key" not in sys.argv or "-publish" not in sys.argv or "-out" not in sys.argv:
+        print(
+            "Accepted parameters: -key <key>, -publish <db file>, -out <dir>, -zstd, -upload"
+        )
+        exit(1)
+
+    key = sys.argv[sys.argv.index("-key") + 1]
+    db_path = sys.argv[sys.argv.index("-publish") + 1]
+    out_dir = sys.argv[sys.argv.index("-out") + 1]
+    codec = encrypt.CODEC_ZSTD if "-zstd" in sys.argv else encrypt.CODEC_NONE
+    manifest = publish(db_path, out_dir, key, codec)
+    print(f"Published {len(manifest['partitions'])} partitions to {out_dir}")
+
+    if "-upload" in sys.argv:
+        upload(
+            out_dir,
+            datasources.get_s3_client(),
+            datasources.R2_BUCKET,
+            datasources.R2_MANIFEST,
+        )
+        print(f"Uploaded to {datasources.R2_MANIFEST}")
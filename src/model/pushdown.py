@@ -0,0 +1,141 @@
+"""
+Source data answered by queries on the panel DB instead of held in memory. The DB stays
+open on disk and each query the app makes is pushed down to SQLite as an indexed query
+(see the indexes in prefect/model/panel_model.py), with results kept in an LRU cache.
+Used instead of source_data.py when PRH_PANEL_BACKEND is "pushdown".
+"""
+
+import logging
+import threading
+import pandas as pd
+import streamlit as st
+from datetime import datetime
+from functools import lru_cache
+from . import datasources, source_data
+
+
+class PushdownData:
+    """
+    Answers the same queries as source_data.SourceData: clinic_patients(),
+    clinic_demographics() and patient_encounters(). Results are read-only and shared by
+    all sessions through an LRU cache of cache_entries results.
+    """
+
+    def __init__(self, conn, cache_entries: int = datasources.QUERY_CACHE_ENTRIES):
+        self.conn = conn
+        self._lock = threading.Lock()
+        self._cached = lru_cache(maxsize=cache_entries)(
+            lambda fn, *args: source_data.read_only(fn(*args))
+        )
+
+        modified = self._fetchall("select max(modified) from meta")[0][0]
+        if isinstance(modified, str):
+            modified = datetime.fromisoformat(modified)
+        self.modified = modified
+
+        # Same form as SourceData.version
+        counts = [
+            self._fetchall(f"select count(*) from {table}")[0][0]
+            for table in ["patients", "encounters"]
+        ]
+        self.version = "/".join(str(value) for value in [modified] + counts)
+
+        clinics = self._fetchall(
+            f"select distinct {source_data.CLINIC_COLUMN} from patients"
+            f" where {source_data.CLINIC_COLUMN} is not null"
+        )
+        self.clinics = sorted(row[0] for row in clinics)
+
+    def clinic_patients(self, clinic: str = None) -> pd.DataFrame:
+        """
+        Return the patients paneled to clinic, or all patients if clinic is None
+        """
+        return self._cached(self._read_clinic_patients, clinic)
+
+    def clinic_demographics(self, clinic: str = None) -> pd.DataFrame:
+        """
+        Return patient counts for clinic, or all clinics if clinic is None, in the form of
+        source_data.demographic_cube()
+        """
+        return self._cached(self._read_clinic_demographics, clinic)
+
+    def patient_encounters(self, key) -> pd.DataFrame:
+        """
+        Return the encounters of the patient with ENCOUNTER_KEY key, in date order
+        """
+        return self._cached(self._read_patient_encounters, str(key))
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    def _read_clinic_patients(self, clinic):
+        if clinic is None:
+            return self._read_table("patients", "order by prw_id")
+        return self._read_table(
+            "patients",
+            f"where {source_data.CLINIC_COLUMN} = ? order by prw_id",
+            (clinic,),
+        )
+
+    def _read_clinic_demographics(self, clinic):
+        where, params = "", ()
+        if clinic is not None:
+            where, params = f"where {source_data.CLINIC_COLUMN} = ?", (clinic,)
+        rows = self._fetchall(
+            f"""
+            select {source_data.CLINIC_COLUMN}, sex, {age_group_sql()}, location, count(*)
+            from patients {where}
+            group by 1, 2, 3, 4
+            """,
+            params,
+        )
+        columns = ["clinic", "sex", "age_group", "location", "count"]
+        df = pd.DataFrame(rows, columns=columns)
+        df["age_group"] = pd.Categorical(
+            df["age_group"], categories=source_data.AGE_LABELS, ordered=True
+        )
+        return df.astype({"count": "int64"})
+
+    def _read_patient_encounters(self, key):
+        return self._read_table(
+            "encounters",
+            f"where {source_data.ENCOUNTER_KEY} = ? order by encounter_date, id",
+            (key,),
+        )
+
+    def _read_table(self, table, where, params=()):
+        with self._lock:
+            return source_data.read_table(self.conn, table, where, params)
+
+    def _fetchall(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+
+def age_group_sql() -> str:
+    """
+    Return a SQL expression for the age group of age, matching the pd.cut() of
+    source_data.AGE_BINS in source_data.demographic_cube()
+    """
+    bins = source_data.AGE_BINS
+    cases = [f"when age is null or age < {bins[0]} then null"]
+    for upper, label in zip(bins[1:], source_data.AGE_LABELS):
+        if upper == float("inf"):
+            cases.append(f"else '{label}'")
+        else:
+            cases.append(f"when age < {upper} then '{label}'")
+    return f"case {' '.join(cases)} end"
+
+
+@st.cache_resource
+def from_file(path: str = datasources.LOCAL_DB_PATH) -> PushdownData:
+    return PushdownData(datasources.open_file(path))
+
+
+@st.cache_resource
+def from_s3() -> PushdownData:
+    """
+    Query a private decrypted copy of the remote DB
+    """
+    logging.info("Opening remote DB for queries")
+    return PushdownData(datasources.connect_s3_file())
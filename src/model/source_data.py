@@ -2,14 +2,185 @@
 Source data as in-memory copy of all DB tables as dataframes
 """
 
+import os
+import inspect
 import logging
+import functools
+import threading
+import numpy as np
 import pandas as pd
 import streamlit as st
+from pandas.api.types import union_categoricals
 from dataclasses import dataclass
 from datetime import datetime
-from sqlmodel import Session, text
+from typing import TYPE_CHECKING
 from . import datasources
 
+# pyarrow and partitions are imported where used to keep app startup fast
+if TYPE_CHECKING:
+    import pyarrow as pa
+
+
+# Column dtypes of the DB tables, following prefect/model/panel_model.py. Strings with few
+# distinct values are read as categoricals. Columns not listed are read as objects.
+DB_DTYPES = {
+    "patients": {
+        "prw_id": "int64",
+        "mrn": "object",
+        "sex": "category",
+        "age": "Int64",
+        "age_in_mo": "Int64",
+        "age_display": "category",
+        "location": "category",
+        "pcp": "category",
+        "panel_location": "category",
+        "panel_provider": "category",
+    },
+    "encounters": {
+        "id": "int64",
+        "prw_id": "int64",
+        "mrn": "object",
+        "location": "category",
+        "encounter_date": "datetime64[ns]",
+        "encounter_type": "category",
+        "service_provider": "category",
+        "with_pcp": "boolean",
+        "diagnoses": "object",
+        "level_of_service": "category",
+    },
+}
+
+# Rows fetched from the DB cursor at a time
+DB_BATCH_SIZE = 50_000
+
+# String columns with at most this fraction of distinct values are dictionary encoded by
+# compact()
+CATEGORY_MAX_RATIO = 0.5
+
+
+# Encounters column identifying the patient selected in the patient table
+ENCOUNTER_KEY = "mrn"
+
+# Patients column with the clinic each patient is paneled to
+CLINIC_COLUMN = "panel_location"
+
+# Age groups for demographic counts. Bins include their lower bound.
+AGE_BINS = [0, 1, 18, 65, float("inf")]
+AGE_LABELS = ["<1y", "<18y", "18-65y", ">65y"]
+
+
+@dataclass(eq=True, frozen=True)
+class EncounterIndex:
+    """
+    Index of encounters sorted by patient, so each patient's encounters are one contiguous
+    slice. keys are the distinct patient keys in sorted order, and the encounters of
+    keys[i] are rows offsets[i] to offsets[i + 1].
+    """
+
+    keys: np.ndarray
+    offsets: np.ndarray
+
+    @classmethod
+    def build(cls, encounters_df: pd.DataFrame) -> "EncounterIndex":
+        """
+        Build the index for encounters_df, which must be sorted with sort_encounters()
+        """
+        keys = _key_strings(encounters_df[ENCOUNTER_KEY])
+        starts = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+        offsets = np.concatenate([[0], starts, [len(keys)]]).astype(np.int64)
+        return cls(keys=keys[offsets[:-1]], offsets=offsets)
+
+    def lookup(self, encounters_df: pd.DataFrame, key) -> pd.DataFrame:
+        """
+        Return the encounters for patient key as a slice of encounters_df, in O(log n)
+        without copying
+        """
+        key = str(key)
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return encounters_df.iloc[self.offsets[i] : self.offsets[i + 1]]
+        return encounters_df.iloc[0:0]
+
+
+class ReadOnlyFrame(pd.DataFrame):
+    """
+    DataFrame shared by all sessions, which raises an error on assignment to its columns
+    or values. Results of operations on it, eg. copy() or slices, are plain DataFrames.
+    """
+
+    @property
+    def _constructor(self):
+        return pd.DataFrame
+
+    def _read_only(self, *args, **kwargs):
+        raise ValueError(
+            "Source data is shared and read-only. Modify a copy() instead."
+        )
+
+    __setitem__ = __delitem__ = insert = isetitem = _read_only
+
+    # Covers the in-place methods and operators, eg. rename(inplace=True) or +=
+    _update_inplace = _read_only
+
+    columns = property(lambda self: pd.DataFrame.columns.__get__(self), _read_only)
+    index = property(lambda self: pd.DataFrame.index.__get__(self), _read_only)
+
+    @property
+    def loc(self):
+        return _ReadOnlyIndexer(super().loc)
+
+    @property
+    def iloc(self):
+        return _ReadOnlyIndexer(super().iloc)
+
+    @property
+    def at(self):
+        return _ReadOnlyIndexer(super().at)
+
+    @property
+    def iat(self):
+        return _ReadOnlyIndexer(super().iat)
+
+
+class _ReadOnlyIndexer:
+    def __init__(self, indexer):
+        self._indexer = indexer
+
+    def __getitem__(self, key):
+        return self._indexer[key]
+
+    def __setitem__(self, key, value):
+        ReadOnlyFrame._read_only(None)
+
+    def __call__(self, axis=None):
+        return _ReadOnlyIndexer(self._indexer(axis))
+
+
+def _no_inplace(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if kwargs.get("inplace"):
+            self._read_only()
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+# Some methods, eg. fillna() and where(), modify the data before calling _update_inplace(),
+# so inplace=True is rejected before the call
+for _name, _method in inspect.getmembers(pd.DataFrame, inspect.isfunction):
+    if not _name.startswith("_") and "inplace" in inspect.signature(_method).parameters:
+        setattr(ReadOnlyFrame, _name, _no_inplace(_method))
+
+
+def read_only(df: pd.DataFrame) -> ReadOnlyFrame:
+    """
+    Return df as a ReadOnlyFrame, without copying its data
+    """
+    if df is None or isinstance(df, ReadOnlyFrame):
+        return df
+    return ReadOnlyFrame(df, copy=False)
+
 
 @dataclass(eq=True, frozen=True)
 class SourceData:
@@ -21,37 +192,467 @@ class SourceData:
     # Metadata
     modified: datetime = None
 
+    # Built from encounters_df when not given
+    encounter_index: EncounterIndex = None
+
+    # Row positions in patients_df of the patients paneled to each clinic. Built from
+    # patients_df when not given.
+    clinic_rows: dict[str, np.ndarray] = None
+
+    # Patient counts by clinic, sex, age group and location. Built from patients_df when
+    # not given.
+    demographics: pd.DataFrame = None
+
+    def __post_init__(self):
+        self._init_indexes()
+        for name in ["patients_df", "encounters_df", "demographics"]:
+            object.__setattr__(self, name, read_only(getattr(self, name)))
+
+    def _init_indexes(self):
+        if self.patients_df is not None and self.clinic_rows is None:
+            object.__setattr__(self, "clinic_rows", partition_clinics(self.patients_df))
+        if self.patients_df is not None and self.demographics is None:
+            object.__setattr__(self, "demographics", demographic_cube(self.patients_df))
+        if self.encounters_df is None or self.encounter_index is not None:
+            return
+        keys = _key_strings(self.encounters_df[ENCOUNTER_KEY])
+        if not pd.Index(keys).is_monotonic_increasing:
+            # Loaders sort encounters before compacting them. Sorting here copies.
+            logging.info("Sorting encounters by patient")
+            object.__setattr__(
+                self, "encounters_df", sort_encounters(self.encounters_df)
+            )
+        object.__setattr__(
+            self, "encounter_index", EncounterIndex.build(self.encounters_df)
+        )
+
+    @property
+    def clinics(self) -> list[str]:
+        """Clinics that have paneled patients, in alphabetical order"""
+        return sorted(self.clinic_rows or {})
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the data loaded, to key values derived from it. Equal for copies of the
+        same data.
+        """
+        return "/".join(
+            str(value)
+            for value in [
+                self.modified,
+                None if self.patients_df is None else len(self.patients_df),
+                None if self.encounters_df is None else len(self.encounters_df),
+            ]
+        )
+
+    # Queries used by the app. pushdown.PushdownData answers the same ones from the DB.
+    def clinic_patients(self, clinic: str = None) -> pd.DataFrame:
+        """
+        Return the patients paneled to clinic, or all patients if clinic is None
+        """
+        if clinic is None:
+            return self.patients_df
+        rows = self.clinic_rows.get(clinic, [])
+        return read_only(self.patients_df.take(rows))
+
+    def clinic_demographics(self, clinic: str = None) -> pd.DataFrame:
+        """
+        Return the rows of demographics for clinic, or all rows if clinic is None
+        """
+        if clinic is None:
+            return self.demographics
+        return read_only(self.demographics[self.demographics["clinic"] == clinic])
+
+    def patient_encounters(self, key) -> pd.DataFrame:
+        """
+        Return the encounters of the patient with ENCOUNTER_KEY key, in date order
+        """
+        return self.encounter_index.lookup(self.encounters_df, key)
+
+
+def partition_clinics(patients_df: pd.DataFrame) -> dict[str, np.ndarray]:
+    """
+    Return the row positions of the patients paneled to each clinic. Patients without a
+    clinic are left out.
+    """
+    return {
+        str(clinic): rows
+        for clinic, rows in patients_df.groupby(
+            CLINIC_COLUMN, observed=True
+        ).indices.items()
+    }
+
+
+def demographic_cube(patients_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return the number of patients for each combination of clinic, sex, age_group and
+    location that occurs in patients_df. Missing values are kept as their own group, so
+    counts add up to the number of patients.
+    """
+    age_group = pd.cut(
+        patients_df["age"].astype("float64"),
+        bins=AGE_BINS,
+        labels=AGE_LABELS,
+        right=False,
+    )
+    keys = {
+        "clinic": patients_df[CLINIC_COLUMN],
+        "sex": patients_df["sex"],
+        "age_group": age_group,
+        "location": patients_df["location"],
+    }
+    return (
+        pd.DataFrame(keys)
+        .groupby(list(keys), observed=True, dropna=False)
+        .size()
+        .rename("count")
+        .reset_index()
+    )
+
+
+def sort_encounters(encounters_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return encounters sorted by patient key, then date, as required by EncounterIndex
+    """
+    order = (
+        pd.DataFrame(
+            {
+                "key": _key_strings(encounters_df[ENCOUNTER_KEY]),
+                "date": encounters_df["encounter_date"],
+            }
+        )
+        .sort_values(["key", "date"], kind="stable")
+        .index
+    )
+    return encounters_df.take(order).reset_index(drop=True)
+
+
+def _key_strings(col: pd.Series) -> np.ndarray:
+    # Missing keys sort first, as NULLs do in SQL
+    return col.astype("string").fillna("").to_numpy(dtype=object)
 
-@st.cache_data
-def from_file() -> SourceData:
-    engine = datasources.connect_file()
+
+# from_file(), from_s3() and from_partitions() are cached as resources, so one read-only
+# SourceData is shared by all sessions. st.cache_data would unpickle a copy of all the
+# data for every session on every rerun.
+@st.cache_resource
+def from_file(path: str = datasources.LOCAL_DB_PATH) -> SourceData:
+    return read_file(path)
+
+
+def read_file(path: str = datasources.LOCAL_DB_PATH) -> SourceData:
+    engine = datasources.connect_file(path)
     src_data = from_db(engine)
     engine.dispose()
     return src_data
 
 
-@st.cache_data
+@st.cache_resource
 def from_s3() -> SourceData:
+    return read_s3()
+
+
+def read_s3() -> SourceData:
     engine = datasources.connect_s3()
     src_data = from_db(engine)
     engine.dispose()
     return src_data
 
 
+@st.cache_resource
+def from_snapshot(path: str = datasources.SNAPSHOT_DIR) -> SourceData:
+    """
+    Read tables from the Arrow snapshot in the path directory. Files are memory mapped and
+    string columns stay backed by the mapped pages, so they are shared by all processes on
+    the host instead of copied into each one.
+    """
+    logging.info("Reading DB snapshot")
+    patients_df, metadata = read_arrow(os.path.join(path, "patients.arrow"))
+    encounters_df, _ = read_arrow(os.path.join(path, "encounters.arrow"))
+
+    modified = metadata.get(b"modified")
+    modified = datetime.fromisoformat(modified.decode()) if modified else None
+    return SourceData(
+        patients_df=patients_df, encounters_df=encounters_df, modified=modified
+    )
+
+
+def read_arrow(path: str) -> tuple[pd.DataFrame, dict]:
+    """
+    Memory map an Arrow IPC file and return it as a dataframe along with its metadata
+    """
+    import pyarrow as pa
+
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    return arrow_to_pandas(table), table.schema.metadata or {}
+
+
+def arrow_to_pandas(table: "pa.Table") -> pd.DataFrame:
+    """
+    Convert an Arrow table to a dataframe, keeping strings in Arrow memory
+    """
+    import pyarrow as pa
+
+    return table.to_pandas(
+        split_blocks=True,
+        coerce_temporal_nanoseconds=True,
+        date_as_object=False,
+        types_mapper={pa.string(): pd.StringDtype("pyarrow")}.get,
+    )
+
+
+@st.cache_resource
+def from_partitions(manifest_key: str = datasources.R2_MANIFEST) -> SourceData:
+    return read_partitions(manifest_key)
+
+
+def read_partitions(manifest_key: str = datasources.R2_MANIFEST) -> SourceData:
+    """
+    Read tables published as partitions (see partitions.py) from remote storage. Only the
+    compacted tables are kept in memory. Partitions that did not change since the last
+    read are in the local download cache, so a refresh only downloads changed partitions.
+
+    Every partition is still decrypted and parsed on each read, and the full tables are
+    sorted and compacted again, so refresh time scales with the size of the data rather
+    than of the change. Encounters are ordered by patient across all year partitions,
+    so the sort and the indexes built on it cannot be reused per partition. Keeping
+    compacted frames of each partition would only save decrypting and compacting them,
+    at the cost of holding a second copy of the data.
+    """
+    from . import partitions
+
+    s3_client = datasources.get_s3_client()
+    manifest = partitions.fetch_manifest(s3_client, datasources.R2_BUCKET, manifest_key)
+
+    # Cached partitions of this manifest are not evicted while fetching its others, even
+    # if together they are over the cache size limit
+    cache_dir = datasources.CACHE_DIR
+    keep = {
+        partitions.cache_path(manifest_key, part, cache_dir)
+        for part in manifest["partitions"]
+        if cache_dir
+    }
+
+    tables = {}
+    for part in manifest["partitions"]:
+        logging.info(f"Reading partition {part['name']}")
+        table = partitions.fetch_partition(
+            s3_client,
+            datasources.R2_BUCKET,
+            manifest_key,
+            part,
+            datasources.DATA_KEY,
+            cache_dir,
+            keep,
+        )
+        tables.setdefault(part["table"], []).append(arrow_to_pandas(table))
+    tables = {
+        table: pd.concat(table_dfs, ignore_index=True)
+        for table, table_dfs in tables.items()
+    }
+    tables["encounters"] = sort_encounters(tables["encounters"])
+    tables = {table: compact(df) for table, df in tables.items()}
+
+    modified = manifest.get("modified")
+    return SourceData(
+        patients_df=tables["patients"],
+        encounters_df=tables["encounters"],
+        modified=datetime.fromisoformat(modified) if modified else None,
+    )
+
+
+class Refresher:
+    """
+    Keeps a SourceData current in the background. Every interval seconds, calls
+    version_fn() and if the result changed, calls load_fn() on a background thread and
+    swaps in the new data. Readers keep getting the previous data until the swap.
+    """
+
+    def __init__(self, load_fn, version_fn, interval: float):
+        self.load_fn = load_fn
+        self.version_fn = version_fn
+        self.interval = interval
+        self.version = version_fn()
+        self.data = load_fn()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="source-data-refresh", daemon=True
+        )
+        self._thread.start()
+
+    def refresh(self):
+        """
+        Check for new data now instead of waiting for the next interval
+        """
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                version = self.version_fn()
+                if version != self.version:
+                    logging.info(f"Remote data changed ({version}), reloading")
+                    data = self.load_fn()
+                    # Single reference assignments, so readers see the old or new data
+                    self.data, self.version = data, version
+            except Exception as e:
+                logging.error("Background refresh failed: %s", e)
+
+
+@st.cache_resource
+def refresher(interval: float = datasources.REFRESH_SECONDS) -> Refresher:
+    """
+    Start one background refresher per process for the remote DB, or its partitions if
+    published that way. The first call blocks on the initial load.
+    """
+    if datasources.R2_MANIFEST:
+        load_fn, obj = read_partitions, datasources.R2_MANIFEST
+    else:
+        load_fn, obj = read_s3, datasources.R2_OBJECT
+    return Refresher(load_fn, lambda: datasources.remote_version(obj), interval)
+
+
+def from_refresher() -> SourceData:
+    """
+    Return the latest data loaded by the background refresher
+    """
+    return refresher().data
+
+
 def from_db(db_engine) -> SourceData:
     """
     Read all data from specified DB connection into memory and return as dataframes
     """
     logging.info("Reading DB tables")
+    conn = db_engine.raw_connection()
+    try:
+        # Read the largest last_updated value from Meta
+        cursor = conn.cursor()
+        modified = cursor.execute("select max(modified) from meta").fetchone()[0]
+        if isinstance(modified, str):
+            modified = datetime.fromisoformat(modified)
 
-    # Read the largest last_updated value from Meta
-    with Session(db_engine) as session:
-        modified = session.exec(text("select max(modified) from meta")).fetchone()[0]
-
-    # Read dashboard data into dataframes
-    dfs = {
-        "patients_df": pd.read_sql_table("patients", db_engine),
-        "encounters_df": pd.read_sql_table("encounters", db_engine),
-    }
+        # Read dashboard data into dataframes
+        dfs = {
+            "patients_df": compact(read_table(conn, "patients")),
+            "encounters_df": compact(sort_encounters(read_table(conn, "encounters"))),
+        }
+    finally:
+        conn.close()
 
     return SourceData(modified=modified, **dfs)
+
+
+def read_table(conn, table: str, where: str = "", params=()) -> pd.DataFrame:
+    """
+    Read a table from a DBAPI connection in batches, converting each batch to the column
+    types in DB_DTYPES as it is read so the Python objects for each row are short lived.
+    where is an optional SQL clause appended to the query, with parameters params.
+    """
+    dtypes = DB_DTYPES.get(table, {})
+    cursor = conn.cursor()
+    cursor.execute(f"select * from {table} {where}", params)
+    columns = [desc[0] for desc in cursor.description]
+    batches = {column: [] for column in columns}
+    while rows := cursor.fetchmany(DB_BATCH_SIZE):
+        for column, values in zip(columns, zip(*rows)):
+            batches[column].append(_typed_array(values, dtypes.get(column, "object")))
+
+    data = {}
+    for column in columns:
+        dtype = dtypes.get(column, "object")
+        arrays = batches.pop(column)
+        if not arrays:
+            data[column] = _typed_array([], dtype)
+        elif dtype == "category":
+            data[column] = union_categoricals(arrays)
+        else:
+            data[column] = pd.concat(
+                [pd.Series(array, copy=False) for array in arrays], ignore_index=True
+            )
+    return pd.DataFrame(data)
+
+
+def _typed_array(values, dtype: str):
+    if dtype == "category":
+        # Categories of an all-NULL batch would otherwise be inferred as float64, which
+        # union_categoricals() cannot combine with the object categories of other batches
+        return pd.Categorical(pd.Series(values, dtype=object))
+    if dtype == "datetime64[ns]":
+        return pd.to_datetime(pd.Series(values, dtype=object), format="ISO8601")
+    if dtype == "object":
+        return pd.Series(values, dtype=object)
+    return pd.array(values, dtype=dtype)
+
+
+def compact(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return a compact, read-only copy of df. String columns with few distinct values are
+    dictionary encoded and others are stored as Arrow strings, integers are downcast to
+    the smallest type that holds them, and the arrays backing each column are made
+    read-only so in-place edits raise an error.
+    """
+    columns = {}
+    for name, col in df.items():
+        if pd.api.types.is_object_dtype(col.dtype) or isinstance(
+            col.dtype, pd.StringDtype
+        ):
+            if col.nunique() <= len(col) * CATEGORY_MAX_RATIO:
+                col = col.astype("category")
+            elif pd.api.types.infer_dtype(col, skipna=True) == "string":
+                col = col.astype(pd.StringDtype("pyarrow"))
+        elif pd.api.types.is_integer_dtype(col.dtype):
+            col = pd.to_numeric(col, downcast="integer")
+        columns[name] = pd.Series(_read_only_array(col), name=name, copy=False)
+    return pd.DataFrame(columns, copy=False)
+
+
+def _read_only_array(col: pd.Series):
+    """
+    Return a copy of the values of col in arrays that are not writeable
+    """
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        col = col.cat.remove_unused_categories()
+        codes = col.cat.codes.to_numpy(copy=True)
+        codes.flags.writeable = False
+        return pd.Categorical.from_codes(codes, dtype=col.dtype)
+    if isinstance(col.array, pd.arrays.IntegerArray | pd.arrays.BooleanArray):
+        numpy_dtype = col.dtype.numpy_dtype
+        values = col.to_numpy(dtype=numpy_dtype, na_value=numpy_dtype.type(0))
+        mask = col.isna().to_numpy()
+        values.flags.writeable = False
+        mask.flags.writeable = False
+        return type(col.array)(values, mask)
+    if isinstance(col.array, pd.api.extensions.ExtensionArray) and not isinstance(
+        col.array, pd.arrays.NumpyExtensionArray | pd.arrays.DatetimeArray
+    ):
+        # Other extension arrays, eg. Arrow backed strings, are already immutable
+        return col.array
+    values = col.to_numpy(copy=True)
+    # pandas cannot read object arrays that are not writeable
+    values.flags.writeable = values.dtype == object
+    return values
+
+
+def memory_report(src_data: SourceData) -> pd.DataFrame:
+    """
+    Return the bytes used by each column of each table, including string contents
+    """
+    rows = []
+    for table, df in [
+        ("patients", src_data.patients_df),
+        ("encounters", src_data.encounters_df),
+    ]:
+        for column, nbytes in df.memory_usage(deep=True).items():
+            rows.append(
+                {
+                    "table": table,
+                    "column": column,
+                    "dtype": str(df[column].dtype) if column in df else "",
+                    "bytes": int(nbytes),
+                }
+            )
+    return pd.DataFrame(rows)
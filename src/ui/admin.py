@@ -0,0 +1,36 @@
+import streamlit as st
+from ..model import source_data
+
+
+def st_page(src_data: source_data.SourceData):
+    """
+    Show admin page with data status and memory use. Open with ?view=admin
+    """
+    st.write("# Admin")
+    st.write(f"Data last modified: {src_data.modified}")
+
+    if not isinstance(src_data, source_data.SourceData):
+        # Pushdown backend, with no tables in memory
+        st.write("## Query cache")
+        info = src_data.cache_info()
+        cols = st.columns(3)
+        cols[0].metric("Entries", f"{info.currsize} / {info.maxsize}")
+        cols[1].metric("Hits", info.hits)
+        cols[2].metric("Misses", info.misses)
+        return
+
+    st.write("## Memory")
+    report = source_data.memory_report(src_data)
+    report["MB"] = report["bytes"] / 2**20
+    totals = report.groupby("table", sort=False)["MB"].sum()
+
+    cols = st.columns(len(totals) + 1)
+    cols[0].metric("Total", f"{totals.sum():.1f} MB")
+    for col, (table, mb) in zip(cols[1:], totals.items()):
+        col.metric(table.capitalize(), f"{mb:.1f} MB")
+
+    st.dataframe(
+        report[["table", "column", "dtype", "MB"]].style.format({"MB": "{:.2f}"}),
+        hide_index=True,
+        use_container_width=True,
+    )
@@ -1,6 +1,5 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
 from . import ui
 from ..model import source_data, data
 
@@ -17,13 +16,13 @@ def st_page(src_data: source_data.SourceData):
 
     st.write("# Panel Explorer (2024)")
 
-    st_patient_details(app_data.paneled_patients_df)
+    st_patient_details(app_data.demographics)
 
     st.write("## Patient List")
     selected_mrn = st_patient_table(app_data.paneled_patients_df)
 
     st.write("## Encounters")
-    st_encounter_table(app_data.encounters_df, selected_mrn)
+    st_encounter_table(src_data, selected_mrn)
 
 
 def st_patient_table(patients_df: pd.DataFrame):
@@ -61,12 +60,23 @@ def st_patient_table(patients_df: pd.DataFrame):
     return None
 
 
-def st_patient_details(patients_df: pd.DataFrame):
-    st.write(f"#### Number of patients: {len(patients_df)}")
+def st_patient_details(demographics: pd.DataFrame):
+    """
+    Show charts of patient demographics from the precomputed counts in
+    source_data.demographic_cube()
+    """
+    st.write(f"#### Number of patients: {demographics['count'].sum()}")
+
+    # Imported here since it is slow to import, so earlier elements render first
+    import plotly.express as px
 
     col1, col2 = st.columns(2)
     with col2:
-        sex_counts = patients_df["sex"].value_counts()
+        sex_counts = (
+            demographics.groupby("sex", observed=True)["count"]
+            .sum()
+            .sort_values(ascending=False)
+        )
 
         fig = px.pie(
             sex_counts,
@@ -87,13 +97,10 @@ def st_patient_details(patients_df: pd.DataFrame):
         st.plotly_chart(fig)
 
     with col1:
-        age_bins = [0, 1, 18, 65, float("inf")]
-        age_labels = ["<1y", "<18y", "18-65y", ">65y"]
-        patients_df["age_group"] = pd.cut(
-            patients_df["age"], bins=age_bins, labels=age_labels, right=False
-        )
-
-        age_group_counts = patients_df["age_group"].value_counts().sort_index()
+        # Includes age groups with no patients, in age order
+        age_group_counts = demographics.groupby("age_group", observed=False)[
+            "count"
+        ].sum()
 
         fig = px.pie(
             age_group_counts,
@@ -113,12 +120,15 @@ def st_patient_details(patients_df: pd.DataFrame):
         )
         st.plotly_chart(fig)
 
-    location_counts = patients_df["location"].value_counts()
-    location_counts["Other"] = location_counts[location_counts < 20].sum()
+    location_counts = (
+        demographics.groupby("location", observed=True)["count"]
+        .sum()
+        .sort_values(ascending=False)
+    )
     location_counts = pd.concat(
         [
             location_counts[location_counts >= 20],
-            pd.Series({"Other": location_counts["Other"]}),
+            pd.Series({"Other": location_counts[location_counts < 20].sum()}),
         ]
     )
 
@@ -141,12 +151,11 @@ def st_patient_details(patients_df: pd.DataFrame):
     st.plotly_chart(fig)
 
 
-def st_encounter_table(encounters_df: pd.DataFrame, selected_mrn):
+def st_encounter_table(src_data: source_data.SourceData, selected_mrn):
     if selected_mrn is None:
         return st.write("Select a patient to view encounters")
 
-    encounters_df = encounters_df.copy()
-    encounters_df = encounters_df[encounters_df["mrn"] == selected_mrn]
+    encounters_df = src_data.patient_encounters(selected_mrn)
 
     selected_columns = [
         "location",
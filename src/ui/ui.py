@@ -11,13 +11,7 @@ def show_settings(src_data: source_data.SourceData) -> dict:
         st.write("## Clinic")
         clinic = st.selectbox(
             "",
-            options=[
-                "All",
-                "Pullman Family Medicine",
-                "Residency",
-                "Palouse Pediatrics",
-                "Palouse Medical",
-            ],
+            options=["All"] + src_data.clinics,
             label_visibility="collapsed",
         )
 
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+import streamlit
+
+# App modules read settings from st.secrets when imported. Use an empty secrets file so
+# tests run with the defaults instead of any local .streamlit/secrets.toml.
+_secrets_path = os.path.join(tempfile.mkdtemp(), "secrets.toml")
+open(_secrets_path, "w").close()
+streamlit.config.set_option("secrets.files", [_secrets_path])
+
+# App modules are imported as the src package, as when run from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,331 @@
+import io
+import os
+import sqlite3
+import tempfile
+import boto3
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+from src.model import datasources
+
+BUCKET = "bucket"
+OBJ = "panel.sqlite3.enc"
+ETAG = '"abc123"'
+
+# Range size of 1 KB, so tests use small objects
+RANGE_MB = 1 / 2**10
+RANGE_SIZE = 2**10
+
+
+@pytest.fixture
+def s3():
+    client = boto3.client(
+        "s3",
+        region_name="us-east-1",
+        aws_access_key_id="test",
+        aws_secret_access_key="test",
+    )
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_sleep(monkeypatch):
+    monkeypatch.setattr(datasources.time, "sleep", lambda seconds: None)
+
+
+def data_of(size: int) -> bytes:
+    return bytes(i % 251 for i in range(size))
+
+
+def add_range(stubber, data, start, end, body=None, if_match=None, if_none_match=None):
+    """
+    Expect a GET of bytes [start, end) of data, and respond with body if given
+    """
+    body = data[start:end] if body is None else body
+    expected = {"Bucket": BUCKET, "Key": OBJ, "Range": f"bytes={start}-{end - 1}"}
+    if if_match:
+        expected["IfMatch"] = if_match
+    if if_none_match:
+        expected["IfNoneMatch"] = if_none_match
+    end = min(end, len(data))
+    stubber.add_response(
+        "get_object",
+        {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "ETag": ETAG,
+            "ContentLength": len(body),
+            "ContentRange": f"bytes {start}-{end - 1}/{len(data)}",
+        },
+        expected,
+    )
+
+
+def download(client, **kwargs):
+    return datasources.download(
+        client, BUCKET, OBJ, range_mb=RANGE_MB, workers=1, **kwargs
+    )
+
+
+def test_empty_object(s3):
+    client, stubber = s3
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="InvalidRange",
+        http_status_code=416,
+        expected_params={
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes=0-{RANGE_SIZE - 1}",
+        },
+    )
+    stubber.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(b""), 0), "ETag": ETAG, "ContentLength": 0},
+        {"Bucket": BUCKET, "Key": OBJ},
+    )
+
+    assert download(client) == (ETAG, b"")
+
+
+@pytest.mark.parametrize(
+    "size", [RANGE_SIZE // 2, RANGE_SIZE], ids=["less_than_one", "exactly_one"]
+)
+def test_single_range(s3, size):
+    client, stubber = s3
+    data = data_of(size)
+    add_range(stubber, data, 0, RANGE_SIZE)
+
+    assert download(client) == (ETAG, data)
+
+
+def test_multiple_ranges_use_if_match(s3):
+    client, stubber = s3
+    data = data_of(RANGE_SIZE * 3 + 100)
+    add_range(stubber, data, 0, RANGE_SIZE)
+    for start in range(RANGE_SIZE, len(data), RANGE_SIZE):
+        end = min(start + RANGE_SIZE, len(data))
+        add_range(stubber, data, start, end, if_match=ETAG)
+
+    etag, result = download(client)
+    assert etag == ETAG
+    assert bytes(result) == data
+
+
+def test_short_range_is_retried(s3):
+    client, stubber = s3
+    data = data_of(RANGE_SIZE * 2 + 10)
+    add_range(stubber, data, 0, RANGE_SIZE)
+    add_range(stubber, data, RANGE_SIZE, RANGE_SIZE * 2, body=b"short", if_match=ETAG)
+    add_range(stubber, data, RANGE_SIZE, RANGE_SIZE * 2, if_match=ETAG)
+    add_range(stubber, data, RANGE_SIZE * 2, len(data), if_match=ETAG)
+
+    assert bytes(download(client)[1]) == data
+
+
+def test_short_first_range_is_retried(s3):
+    client, stubber = s3
+    data = data_of(RANGE_SIZE * 2)
+    add_range(stubber, data, 0, RANGE_SIZE, body=b"short")
+    add_range(stubber, data, 0, RANGE_SIZE, if_match=ETAG)
+    add_range(stubber, data, RANGE_SIZE, RANGE_SIZE * 2, if_match=ETAG)
+
+    assert bytes(download(client)[1]) == data
+
+
+def test_range_fails_after_retries(s3):
+    client, stubber = s3
+    data = data_of(RANGE_SIZE * 2)
+    add_range(stubber, data, 0, RANGE_SIZE)
+    for _ in range(datasources.DOWNLOAD_RETRIES):
+        add_range(stubber, data, RANGE_SIZE, RANGE_SIZE * 2, body=b"", if_match=ETAG)
+
+    with pytest.raises(IOError):
+        download(client)
+
+
+def test_changed_object_fails_if_match(s3):
+    client, stubber = s3
+    data = data_of(RANGE_SIZE * 2)
+    add_range(stubber, data, 0, RANGE_SIZE)
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="PreconditionFailed",
+        http_status_code=412,
+        expected_params={
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes={RANGE_SIZE}-{RANGE_SIZE * 2 - 1}",
+            "IfMatch": ETAG,
+        },
+    )
+
+    with pytest.raises(Exception, match="PreconditionFailed"):
+        download(client)
+
+
+def test_not_modified(s3):
+    client, stubber = s3
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="304",
+        http_status_code=304,
+        expected_params={
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes=0-{RANGE_SIZE - 1}",
+            "IfNoneMatch": ETAG,
+        },
+    )
+
+    assert download(client, if_none_match=ETAG) is None
+
+
+def test_modified_since_if_none_match(s3):
+    client, stubber = s3
+    data = data_of(100)
+    add_range(stubber, data, 0, RANGE_SIZE, if_none_match='"old"')
+
+    assert download(client, if_none_match='"old"') == (ETAG, data)
+
+
+def test_connect_s3_file_keeps_plaintext_out_of_cache(s3, tmp_path, monkeypatch):
+    from cryptography.fernet import Fernet
+    from src.model import encrypt
+
+    db_path = tmp_path / "panel.sqlite3"
+    conn = sqlite3.connect(db_path)
+    conn.execute("create table meta (modified timestamp)")
+    conn.execute("insert into meta values ('2024-06-01')")
+    conn.commit()
+    conn.close()
+    key = Fernet.generate_key().decode("utf-8")
+    with open(db_path, "rb") as f:
+        data = encrypt.encrypt(f.read(), key)
+
+    client, stubber = s3
+    add_range(stubber, data, 0, int(datasources.DOWNLOAD_RANGE_MB * 2**20))
+    monkeypatch.setattr(datasources, "get_s3_client", lambda *args: client)
+    shm_dir, temp_dir, cache_dir = (
+        tmp_path / "shm",
+        tmp_path / "tmp",
+        tmp_path / "cache",
+    )
+    shm_dir.mkdir()
+    temp_dir.mkdir()
+    monkeypatch.setattr(datasources, "SHM_DIR", str(shm_dir))
+    monkeypatch.setattr(tempfile, "tempdir", str(temp_dir))
+    private_files = []
+    mkstemp = tempfile.mkstemp
+
+    def record_mkstemp(*args, **kwargs):
+        fd, path = mkstemp(*args, **kwargs)
+        private_files.append(path)
+        return fd, path
+
+    monkeypatch.setattr(tempfile, "mkstemp", record_mkstemp)
+
+    conn = datasources.connect_s3_file(
+        bucket=BUCKET, obj=OBJ, data_key=key, cache_dir=str(cache_dir)
+    )
+    assert conn.execute("select modified from meta").fetchall() == [("2024-06-01",)]
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("insert into meta values ('2024-07-01')")
+    # Decrypted on disk in the temp directory, not in memory backed SHM_DIR, and removed
+    decrypted = [path for path in private_files if path.endswith(".sqlite3")]
+    assert [os.path.dirname(path) for path in decrypted] == [str(temp_dir)]
+    assert list(shm_dir.iterdir()) == [] and list(temp_dir.iterdir()) == []
+    cached = list(cache_dir.iterdir())
+    assert len(cached) == 1 and cached[0].read_bytes() == data
+
+
+def test_fetch_cached_uses_etag_of_cached_copy(s3, tmp_path):
+    client, stubber = s3
+    cache_dir = str(tmp_path / "cache")
+    data = data_of(100)
+    range_size = int(datasources.DOWNLOAD_RANGE_MB * 2**20)
+
+    # Empty cache: downloaded and stored under its ETag
+    add_range(stubber, data, 0, range_size)
+    path = datasources.fetch_cached(client, BUCKET, OBJ, cache_dir)
+    assert os.path.basename(path) == f"{OBJ}.abc123"
+
+    # Unchanged: If-None-Match with the quoted ETag gets a 304 and the cached copy
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="304",
+        http_status_code=304,
+        expected_params={
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes=0-{range_size - 1}",
+            "IfNoneMatch": ETAG,
+        },
+    )
+    assert datasources.fetch_cached(client, BUCKET, OBJ, cache_dir) == path
+
+    # Changed: the new version is downloaded, and its ETag is sent from then on
+    new_data = data_of(200)[::-1]
+    stubber.add_response(
+        "get_object",
+        {
+            "Body": StreamingBody(io.BytesIO(new_data), len(new_data)),
+            "ETag": '"def456"',
+            "ContentLength": len(new_data),
+            "ContentRange": f"bytes 0-{len(new_data) - 1}/{len(new_data)}",
+        },
+        {
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes=0-{range_size - 1}",
+            "IfNoneMatch": ETAG,
+        },
+    )
+    new_path = datasources.fetch_cached(client, BUCKET, OBJ, cache_dir)
+    assert os.path.basename(new_path) == f"{OBJ}.def456"
+    with open(new_path, "rb") as f:
+        assert f.read() == new_data
+
+    stubber.add_client_error(
+        "get_object",
+        service_error_code="304",
+        http_status_code=304,
+        expected_params={
+            "Bucket": BUCKET,
+            "Key": OBJ,
+            "Range": f"bytes=0-{range_size - 1}",
+            "IfNoneMatch": '"def456"',
+        },
+    )
+    assert datasources.fetch_cached(client, BUCKET, OBJ, cache_dir) == new_path
+
+
+def test_evict_cache_removes_least_recently_used(tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"entry{i}"
+        path.write_bytes(data_of(2**10))
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+    # Used most recently, so kept over newer entries
+    os.utime(paths[0], (2000, 2000))
+    (tmp_path / "partial.part").write_bytes(data_of(2**10))
+
+    datasources.evict_cache(str(tmp_path), max_mb=2.5 / 2**10)
+
+    remaining = sorted(p.name for p in tmp_path.iterdir())
+    assert remaining == ["entry0", "entry3", "partial.part"]
+
+
+def test_evict_cache_never_removes_keep(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"entry{i}"
+        path.write_bytes(data_of(2**10))
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+
+    datasources.evict_cache(str(tmp_path), max_mb=0, keep={str(paths[0])})
+
+    assert list(tmp_path.iterdir()) == [paths[0]]
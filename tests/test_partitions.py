@@ -0,0 +1,128 @@
+import io
+import os
+import sqlite3
+import pytest
+from botocore.response import StreamingBody
+from cryptography.fernet import Fernet
+from src.model import datasources, encrypt, partitions
+
+BUCKET = "bucket"
+MANIFEST_KEY = "panel/manifest.json"
+
+
+class DirS3:
+    """
+    S3 client serving the objects published to a local directory
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        with open(os.path.join(self.out_dir, os.path.basename(Key)), "rb") as f:
+            data = f.read()
+        start, end = map(int, Range.removeprefix("bytes=").split("-"))
+        body = data[start : end + 1]
+        return {
+            "Body": StreamingBody(io.BytesIO(body), len(body)),
+            "ETag": '"etag"',
+            "ContentRange": f"bytes {start}-{start + len(body) - 1}/{len(data)}",
+        }
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = tmp_path / "panel.sqlite3"
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        create table meta (id integer primary key, modified timestamp);
+        insert into meta values (1, '2024-06-01 00:00:00');
+        create table patients (prw_id integer primary key, mrn text);
+        insert into patients values (1, '100001'), (2, '100002');
+        create table encounters (id integer primary key, mrn text, encounter_date date);
+        insert into encounters values
+            (1, '100001', '2023-05-01'), (2, '100002', '2024-02-01');
+        """)
+    conn.commit()
+    conn.close()
+    return str(path)
+
+
+def new_key() -> str:
+    return Fernet.generate_key().decode("utf-8")
+
+
+def test_object_names_change_with_key_and_codec(db_path, tmp_path):
+    key1, key2 = new_key(), new_key()
+    published = [
+        partitions.publish(db_path, str(tmp_path / name), key, codec)
+        for name, key, codec in [
+            ("a", key1, encrypt.CODEC_NONE),
+            ("b", key2, encrypt.CODEC_NONE),
+            ("c", key1, encrypt.CODEC_ZSTD),
+        ]
+    ]
+
+    for parts in zip(*(manifest["partitions"] for manifest in published)):
+        assert len({part["sha256"] for part in parts}) == 1
+        assert len({part["object"] for part in parts}) == 3
+    assert published[0]["partitions"][0]["key_id"] == encrypt.key_id(key1)
+    assert published[2]["partitions"][0]["codec"] == "zstd"
+
+
+def test_fetch_after_key_rotation_ignores_cached_old_objects(db_path, tmp_path):
+    old_key, new = new_key(), new_key()
+    cache_dir = str(tmp_path / "cache")
+    old_dir, new_dir = str(tmp_path / "old"), str(tmp_path / "new")
+
+    old_manifest = partitions.publish(db_path, old_dir, old_key)
+    for part in old_manifest["partitions"]:
+        partitions.fetch_partition(
+            DirS3(old_dir), BUCKET, MANIFEST_KEY, part, old_key, cache_dir
+        )
+
+    new_manifest = partitions.publish(db_path, new_dir, new)
+    tables = {
+        part["name"]: partitions.fetch_partition(
+            DirS3(new_dir), BUCKET, MANIFEST_KEY, part, new, cache_dir
+        )
+        for part in new_manifest["partitions"]
+    }
+    assert tables["patients"].column("mrn").to_pylist() == ["100001", "100002"]
+    assert sorted(tables) == ["encounters-2023", "encounters-2024", "patients"]
+
+
+def test_fetch_with_wrong_key(db_path, tmp_path):
+    out_dir = str(tmp_path / "out")
+    manifest = partitions.publish(db_path, out_dir, new_key())
+
+    with pytest.raises(ValueError, match="configured key"):
+        partitions.fetch_partition(
+            DirS3(out_dir), BUCKET, MANIFEST_KEY, manifest["partitions"][0], new_key()
+        )
+
+
+def test_partitions_of_manifest_are_not_evicted(db_path, tmp_path, monkeypatch):
+    key = new_key()
+    out_dir, cache_dir = str(tmp_path / "out"), str(tmp_path / "cache")
+    manifest = partitions.publish(db_path, out_dir, key)
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "cache" / "stale").write_bytes(b"stale")
+
+    # A cache limit smaller than any partition
+    evict_cache = datasources.evict_cache
+    monkeypatch.setattr(
+        datasources,
+        "evict_cache",
+        lambda cache_dir, max_mb, keep: evict_cache(cache_dir, 0, keep),
+    )
+    keep = {
+        partitions.cache_path(MANIFEST_KEY, part, cache_dir)
+        for part in manifest["partitions"]
+    }
+    for part in manifest["partitions"]:
+        partitions.fetch_partition(
+            DirS3(out_dir), BUCKET, MANIFEST_KEY, part, key, cache_dir, keep
+        )
+
+    assert {str(path) for path in (tmp_path / "cache").iterdir()} == keep
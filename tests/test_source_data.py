@@ -0,0 +1,106 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+from src.model import source_data
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({"a": [3.0, np.nan, 1.0], "b": ["x", "y", "z"]})
+
+
+@pytest.mark.parametrize(
+    "modify",
+    [
+        lambda df: df.__setitem__("a", 0),
+        lambda df: df.__delitem__("a"),
+        lambda df: df.insert(0, "c", 0),
+        lambda df: df.pop("a"),
+        lambda df: df.loc.__setitem__((0, "a"), 0),
+        lambda df: df.iloc.__setitem__((0, 0), 0),
+        lambda df: df.at.__setitem__((0, "a"), 0),
+        lambda df: df.iat.__setitem__((0, 0), 0),
+        lambda df: setattr(df, "columns", ["c", "d"]),
+        lambda df: setattr(df, "index", [5, 6, 7]),
+        lambda df: df.rename(columns={"a": "c"}, inplace=True),
+        lambda df: df.drop(columns="a", inplace=True),
+        lambda df: df.sort_values("a", inplace=True),
+        lambda df: df.set_index("b", inplace=True),
+        lambda df: df.fillna(0, inplace=True),
+        lambda df: df.where(df.isna(), inplace=True),
+        lambda df: df.update(pd.DataFrame({"a": [9.0, 9.0, 9.0]})),
+    ],
+    ids=[
+        "setitem",
+        "delitem",
+        "insert",
+        "pop",
+        "loc",
+        "iloc",
+        "at",
+        "iat",
+        "columns",
+        "index",
+        "rename",
+        "drop",
+        "sort_values",
+        "set_index",
+        "fillna",
+        "where",
+        "update",
+    ],
+)
+def test_read_only_frame_rejects_changes(df, modify):
+    frame = source_data.read_only(df)
+
+    with pytest.raises(ValueError, match="read-only"):
+        modify(frame)
+    assert_frame_equal(pd.DataFrame(frame), df)
+
+
+def test_read_only_frame_results_are_plain_frames(df):
+    frame = source_data.read_only(df)
+    results = [
+        frame.copy(),
+        frame.rename(columns={"a": "c"}),
+        frame.drop(columns="a"),
+        frame.sort_values("a"),
+        frame.fillna(0),
+        frame.loc[frame["a"] > 1],
+        frame.iloc[:2],
+    ]
+
+    assert all(type(result) is pd.DataFrame for result in results)
+    copy = results[0]
+    copy["a"] = 0
+    copy.columns = ["c", "d"]
+    assert_frame_equal(pd.DataFrame(frame), df)
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ["99213", "99214", None, None],
+        [None, None, "99213", "99214"],
+        ["99213", None, None, None, None, "99213"],
+        [None, None, None, None],
+    ],
+)
+def test_read_table_with_all_null_category_batch(monkeypatch, values):
+    monkeypatch.setattr(source_data, "DB_BATCH_SIZE", 2)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("create table encounters (id integer, level_of_service text)")
+    conn.executemany("insert into encounters values (?, ?)", list(enumerate(values)))
+
+    df = source_data.read_table(conn, "encounters")
+
+    assert isinstance(df["level_of_service"].dtype, pd.CategoricalDtype)
+    assert (
+        df["level_of_service"]
+        .astype(object)
+        .where(df["level_of_service"].notna(), None)
+        .tolist()
+        == values
+    )